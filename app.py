@@ -1,11 +1,16 @@
+import asyncio
+import contextvars
 import json
 import os
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 from chalice import Chalice, Response
 from loguru import logger
-from telegram import ParseMode, Update, Bot
+from telegram import ChatAction, ParseMode, Update
 from telegram.ext import (
     Dispatcher,
     MessageHandler,
@@ -13,10 +18,18 @@ from telegram.ext import (
 )
 
 from chalicelib.classifier import ContentModerationSchema
-from chalicelib.dao import UserRequestsDao, UserAnalyticsDao
-from chalicelib.search import search
+from chalicelib.admission import AdmissionController, ServiceSwitch
+from chalicelib.async_clients import AsyncTelegramBot, EventLoopThread, Offloaded
+from chalicelib.dao import UserRequestsDao, UserAnalyticsDao, ProcessedUpdatesDao, ServiceStateDao
+from chalicelib.idempotency import UpdateDeduplicator, tracking_side_effects
+from chalicelib.coalescing import InFlightRequests, SingleFlight, AsyncSingleFlight
+from chalicelib.search import search, normalize_query, SearchCancelled, get_cached_results, render_answer, \
+    embed_query, needs_embedding, search_async, embed_query_async, get_text_search
+from chalicelib.tracing import tracer, in_current_trace
+from chalicelib.update_queue import SqsUpdateQueue, InMemoryUpdateQueue, LocalUpdateWorker, process_batch, \
+    is_valid_update, process_batch_async
 from chalicelib.utils import generate_transcription, TypingThread, generate_random_image_url, \
-    get_random_list_item
+    get_random_list_item, TracedBot
 
 # Telegram token
 TOKEN = os.environ["TELEGRAM_TOKEN"]
@@ -27,12 +40,13 @@ OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 APP_NAME = "daniel-search-bot-serverless-v2"
 MESSAGE_HANDLER_LAMBDA = "message-handler-lambda"
 WAKEUP_MESSAGE_HANDLER_LAMBDA = "send-wakeup-message-lambda"
+UPDATE_WORKER_LAMBDA = "update-worker-lambda"
 
 app = Chalice(app_name=APP_NAME)
 app.debug = True
 
 # Telegram bot
-bot = Bot(token=TOKEN)
+bot = TracedBot(token=TOKEN)
 dispatcher = Dispatcher(bot, None, use_context=True)
 
 
@@ -42,11 +56,95 @@ class Stage(Enum):
     PROD = 'prod'
 
 
+class ProcessingMode(Enum):
+    # the webhook runs the whole pipeline before it responds
+    SYNC = 'sync'
+    # the webhook only enqueues updates, the update worker processes them
+    QUEUE = 'queue'
+
+
+class ExecutionMode(Enum):
+    # the dispatcher runs the handlers on the calling thread, concurrent stages use a thread pool
+    THREADS = 'threads'
+    # text messages are coroutines on one event loop with asyncio clients for the outbound calls
+    ASYNCIO = 'asyncio'
+
+
 STAGE = Stage(os.environ["STAGE"])
-SERVICE_AVAILABLE = os.environ["SERVICE_AVAILABLE"]
+# default of the search switch in the service_state table
+SERVICE_AVAILABLE = os.environ.get("SERVICE_AVAILABLE", "true")
+MAX_IN_FLIGHT_SEARCHES = int(os.environ.get("MAX_IN_FLIGHT_SEARCHES", "8"))
+ADMISSION_MAX_ERROR_RATE = float(os.environ.get("ADMISSION_MAX_ERROR_RATE", "0.5"))
+ADMISSION_MAX_P95_LATENCY_MS = float(os.environ.get("ADMISSION_MAX_P95_LATENCY_MS", "20000"))
+ADMISSION_COOLDOWN_SECONDS = float(os.environ.get("ADMISSION_COOLDOWN_SECONDS", "30"))
+PROCESSING_MODE = ProcessingMode(os.environ.get("PROCESSING_MODE", "sync"))
+UPDATES_QUEUE = os.environ.get("UPDATES_QUEUE")
+WORKER_BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", "10"))
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "4"))
+COALESCE_WINDOW_SECONDS = float(os.environ.get("COALESCE_WINDOW_SECONDS", "0"))
+PROGRESSIVE_REPLY = os.environ.get("PROGRESSIVE_REPLY", "false").lower() == "true"
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# an update whose processing has not finished in this time can be claimed by a re-delivery
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get("IDEMPOTENCY_LEASE_SECONDS", "300"))
+STAGE_THREADS = int(os.environ.get("STAGE_THREADS", "16"))
+EXECUTION_MODE = ExecutionMode(os.environ.get("EXECUTION_MODE", "threads"))
 
 user_requests_dao = UserRequestsDao()
 user_analytics_dao = UserAnalyticsDao()
+processed_updates_dao = ProcessedUpdatesDao()
+update_deduplicator = UpdateDeduplicator(processed_updates_dao, IDEMPOTENCY_TTL_SECONDS,
+                                         lease_seconds=IDEMPOTENCY_LEASE_SECONDS)
+in_flight_requests = InFlightRequests()
+service_state_dao = ServiceStateDao()
+service_switch = ServiceSwitch(service_state_dao, SERVICE_AVAILABLE.lower() == "true")
+admission_controller = AdmissionController(max_in_flight=MAX_IN_FLIGHT_SEARCHES,
+                                           max_error_rate=ADMISSION_MAX_ERROR_RATE,
+                                           max_p95_latency_ms=ADMISSION_MAX_P95_LATENCY_MS,
+                                           cooldown_seconds=ADMISSION_COOLDOWN_SECONDS)
+single_flight = SingleFlight()
+embedding_flight = SingleFlight()
+# independent stages of a message run concurrently on this pool
+stage_executor = ThreadPoolExecutor(max_workers=STAGE_THREADS)
+
+async_bot = AsyncTelegramBot(TOKEN)
+async_user_requests_dao = Offloaded(user_requests_dao)
+async_user_analytics_dao = Offloaded(user_analytics_dao)
+async_single_flight = AsyncSingleFlight()
+async_embedding_flight = AsyncSingleFlight()
+event_loop = EventLoopThread() if EXECUTION_MODE == ExecutionMode.ASYNCIO else None
+
+
+def start_stage(func, *args):
+    return stage_executor.submit(in_current_trace(func), *args)
+
+
+def embed_query_shared(text, is_cancelled):
+    """`embed_query` shared by identical concurrent questions, only the one that searches uses it."""
+    def embed_once(call):
+        return embed_query(text, lambda: is_cancelled() and call.waiters == 0)
+
+    return embedding_flight.do(normalize_query(text), embed_once)
+
+
+async def embed_query_shared_async(text, is_cancelled):
+    async def embed_once(call):
+        return await embed_query_async(text, lambda: is_cancelled() and call.waiters == 0)
+
+    return await async_embedding_flight.do(normalize_query(text), embed_once)
+
+
+def abandon_embedding(abandoned, query_embedding):
+    """Stops the speculative embedding of an update that is not going to use it."""
+    abandoned.set()
+    if query_embedding is not None:
+        query_embedding.cancel()
+
+
+def log_stage_error(future, stage):
+    try:
+        future.result()
+    except Exception as e:
+        logger.error(f"Stage {stage} failed: {e}")
 
 
 #####################
@@ -104,16 +202,28 @@ def interaction_allowed(user_id) -> bool:
     return requests_count < max_request_count
 
 
+def log_requests_count(user_id, update_result):
+    # the DAO returns None when DynamoDB fails, the answer has been sent by then
+    if update_result is None:
+        logger.error(f"Request count of user {user_id} was not updated")
+    else:
+        logger.info(f"New request count for user {user_id}: {update_result['requests_count']}")
+
+
+def send_request_limit_warning(update, context):
+    request_limit_warning = get_random_request_limit_warning()
+    context.bot.send_message(
+        chat_id=update.message.chat_id,
+        text=request_limit_warning,
+        parse_mode=ParseMode.MARKDOWN,
+    )
+
+
 def block_by_request_count(update, context) -> bool:
     user_id = update.effective_user.id
     block_user = not interaction_allowed(user_id)
     if block_user:
-        request_limit_warning = get_random_request_limit_warning()
-        context.bot.send_message(
-            chat_id=update.message.chat_id,
-            text=request_limit_warning,
-            parse_mode=ParseMode.MARKDOWN,
-        )
+        send_request_limit_warning(update, context)
     return block_user
 
 
@@ -140,9 +250,7 @@ def process_voice_message(update, context):
     try:
         search_result = run_search(chat_id, transcript_msg, context)
         if search_result:
-            update_result = user_requests_dao.update_user_requests_count(user_id)
-            requests_count = update_result['requests_count']
-            logger.info(f"New request count for user {user_id}: {requests_count}")
+            log_requests_count(user_id, user_requests_dao.update_user_requests_count(user_id))
         else:
             logger.info(f"Search process was rejected for user {user_id}")
     finally:
@@ -153,55 +261,322 @@ def process_message(update, context):
     user_id = update.effective_user.id
     chat_id = update.effective_message.chat_id
 
-    user_analytics_dao.update_last_seen(user_id)
+    ticket = in_flight_requests.ticket(user_id, update.update_id)
+    try:
+        if COALESCE_WINDOW_SECONDS:
+            # let a burst of messages arrive and answer only the latest one
+            time.sleep(COALESCE_WINDOW_SECONDS)
+        if ticket.is_superseded():
+            logger.info(f"Update {update.update_id} of user {user_id} is superseded by a newer message")
+            return
+
+        admission = admission_controller.try_acquire() if service_switch.is_on() else None
+        if admission is None:
+            logger.info(f"Search is not admitted for user {user_id}")
+            send_answer_without_search(chat_id, update.message.text, context)
+            return
+
+        try:
+            text = update.message.text
+            # the quota is only known after a DynamoDB read, the search starts speculatively
+            # meanwhile and its result is discarded if the user is over the limit
+            last_seen = start_stage(user_analytics_dao.update_last_seen, user_id)
+            allowed = start_stage(interaction_allowed, user_id)
+            waiting_message = start_stage(send_waiting_message, context, chat_id)
+            abandoned = threading.Event()
+            query_embedding = None
+            if needs_embedding(text):
+                # a question joining an identical search in flight waits for its embedding instead
+                query_embedding = start_stage(embed_query_shared, text,
+                                              lambda: abandoned.is_set() or ticket.is_superseded())
+
+            try:
+                is_allowed = allowed.result()
+                # keeps the waiting message ahead of the answer
+                log_stage_error(waiting_message, "waiting_message")
+                if not is_allowed:
+                    abandon_embedding(abandoned, query_embedding)
+                    send_request_limit_warning(update, context)
+                    return
+
+                typing_thread = TypingThread(context, chat_id)
+                typing_thread.start()
+                try:
+                    search_result = run_search(chat_id, text, context, ticket.is_superseded, admission,
+                                               query_embedding)
+                    if search_result:
+                        log_requests_count(user_id, user_requests_dao.update_user_requests_count(user_id))
+                    else:
+                        logger.info(f"Search process was rejected for user {user_id}")
+                finally:
+                    typing_thread.stop()
+            finally:
+                # the quota check or the search may have raised with the embedding still running
+                abandon_embedding(abandoned, query_embedding)
+                log_stage_error(last_seen, "last_seen")
+        finally:
+            admission.release()
+    finally:
+        in_flight_requests.finish(ticket)
 
-    block_execution = block_by_request_count(update, context)
-    if block_execution:
+
+def send_answer_without_search(chat_id, chat_text, context):
+    cached_results = get_cached_results(chat_text)
+    if cached_results is None:
+        send_service_unavailable_message(chat_id, context)
         return
 
-    send_waiting_message(context, chat_id)
-    typing_thread = TypingThread(context, chat_id)
-    typing_thread.start()
-    try:
-        search_result = run_search(chat_id, update.message.text, context)
-        if search_result:
-            update_result = user_requests_dao.update_user_requests_count(user_id)
-            requests_count = update_result['requests_count']
-            logger.info(f"New request count for user {user_id}: {requests_count}")
-        else:
-            logger.info(f"Search process was rejected for user {user_id}")
-    finally:
-        typing_thread.stop()
+    context.bot.send_photo(
+        chat_id=chat_id,
+        photo=generate_random_image_url(),
+        caption=render_answer(cached_results[:3]),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+
+def run_search(chat_id, chat_text, context, is_cancelled=None, admission=None, query_embedding=None):
+    preliminary_messages = []
 
+    def send_preliminary_answer(answer):
+        try:
+            preliminary_messages.append(context.bot.send_photo(
+                chat_id=chat_id,
+                photo=generate_random_image_url(),
+                caption=answer,
+                parse_mode=ParseMode.MARKDOWN
+            ))
+        except Exception as e:
+            logger.error(f"Preliminary answer was not sent: {e}")
 
-def run_search(chat_id, chat_text, context):
+    def search_once(call):
+        def cancelled():
+            # a search shared with other users keeps running for them
+            return is_cancelled is not None and is_cancelled() and call.waiters == 0
+
+        return search(chat_text, on_preliminary=send_preliminary_answer if PROGRESSIVE_REPLY else None,
+                      is_cancelled=cancelled, embedding_future=query_embedding)
+
+    search_started = time.monotonic()
     try:
-        message = search(chat_text)
+        while True:
+            try:
+                # identical concurrent questions share one search
+                message = single_flight.do(normalize_query(chat_text), search_once)
+                break
+            except SearchCancelled:
+                if is_cancelled is not None and is_cancelled():
+                    logger.info(f"Search for chat {chat_id} is cancelled by a newer message")
+                    return False
+                # the shared search was cancelled by the user who started it, search again
+                # without the speculative embedding, it may have been cancelled as well
+                query_embedding = None
         logger.info(message)
+        if admission is not None:
+            admission.record(search_started)
     except Exception as e:
         app.log.error(e)
         app.log.error(traceback.format_exc())
+        if admission is not None:
+            admission.record(search_started, failed=True)
         send_service_unavailable_message(chat_id, context)
         return False
     else:
-        context.bot.send_photo(
-            chat_id=chat_id,
-            photo=generate_random_image_url(),
-            caption=message,
-            parse_mode=ParseMode.MARKDOWN
-        )
+        if preliminary_messages:
+            context.bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=preliminary_messages[0].message_id,
+                caption=message,
+                parse_mode=ParseMode.MARKDOWN
+            )
+        else:
+            context.bot.send_photo(
+                chat_id=chat_id,
+                photo=generate_random_image_url(),
+                caption=message,
+                parse_mode=ParseMode.MARKDOWN
+            )
         return True
 
 
+SERVICE_UNAVAILABLE_TEXT = "Упс! Кажется, что-то пошло не так 😬 Но не волнуйтесь, наши кодовые мастера уже вовсю трудятся над исправлением проблемы! Повторите попытку позднее ⚙️"
+
+
 def send_service_unavailable_message(chat_id, context):
     context.bot.send_message(
         chat_id=chat_id,
-        text="Упс! Кажется, что-то пошло не так 😬 Но не волнуйтесь, наши кодовые мастера уже вовсю трудятся над исправлением проблемы! Повторите попытку позднее ⚙️",
+        text=SERVICE_UNAVAILABLE_TEXT,
         parse_mode=ParseMode.MARKDOWN,
         disable_web_page_preview=True
     )
 
 
+#############################
+# Asyncio Telegram Handlers #
+#############################
+
+def log_task_error(task, stage):
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and not isinstance(task.exception(), (type(None), SearchCancelled)):
+        logger.error(f"Stage {stage} failed: {task.exception()}")
+
+
+async def keep_typing(chat_id):
+    try:
+        while True:
+            await async_bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+            await asyncio.sleep(3)
+    except Exception as e:
+        logger.error(f"Typing status was not sent: {e}")
+
+
+async def send_waiting_message_async(chat_id):
+    await async_bot.send_message(chat_id=chat_id, text=get_random_waiting_text())
+
+
+async def send_request_limit_warning_async(chat_id):
+    await async_bot.send_message(chat_id=chat_id, text=get_random_request_limit_warning(),
+                                 parse_mode=ParseMode.MARKDOWN)
+
+
+async def send_service_unavailable_message_async(chat_id):
+    await async_bot.send_message(chat_id=chat_id, text=SERVICE_UNAVAILABLE_TEXT, parse_mode=ParseMode.MARKDOWN,
+                                 disable_web_page_preview=True)
+
+
+async def send_answer_without_search_async(chat_id, chat_text):
+    cached_results = get_cached_results(chat_text)
+    if cached_results is None:
+        await send_service_unavailable_message_async(chat_id)
+        return
+
+    await async_bot.send_photo(chat_id=chat_id, photo=generate_random_image_url(),
+                               caption=render_answer(cached_results[:3]), parse_mode=ParseMode.MARKDOWN)
+
+
+async def process_message_async(update):
+    """Asyncio version of `process_message`."""
+    user_id = update.effective_user.id
+    chat_id = update.effective_message.chat_id
+    text = update.message.text
+
+    ticket = in_flight_requests.ticket(user_id, update.update_id)
+    try:
+        if COALESCE_WINDOW_SECONDS:
+            await asyncio.sleep(COALESCE_WINDOW_SECONDS)
+        if ticket.is_superseded():
+            logger.info(f"Update {update.update_id} of user {user_id} is superseded by a newer message")
+            return
+
+        service_on = await asyncio.to_thread(service_switch.is_on)
+        admission = admission_controller.try_acquire() if service_on else None
+        if admission is None:
+            logger.info(f"Search is not admitted for user {user_id}")
+            await send_answer_without_search_async(chat_id, text)
+            return
+
+        abandoned = False
+        query_embedding = None
+        typing = None
+        try:
+            # the lexical lookup and a cold index load block, they stay off the loop
+            if await asyncio.to_thread(needs_embedding, text):
+                query_embedding = asyncio.create_task(
+                    embed_query_shared_async(text, lambda: abandoned or ticket.is_superseded()))
+            last_seen, is_allowed, waiting_message = await asyncio.gather(
+                async_user_analytics_dao.update_last_seen(user_id),
+                asyncio.to_thread(interaction_allowed, user_id),
+                send_waiting_message_async(chat_id),
+                return_exceptions=True)
+            for stage, result in (("last_seen", last_seen), ("waiting_message", waiting_message)):
+                if isinstance(result, Exception):
+                    logger.error(f"Stage {stage} failed: {result}")
+            if isinstance(is_allowed, Exception):
+                raise is_allowed
+            if not is_allowed:
+                abandoned = True
+                await send_request_limit_warning_async(chat_id)
+                return
+
+            typing = asyncio.create_task(keep_typing(chat_id))
+            search_result = await run_search_async(chat_id, text, ticket.is_superseded, admission, query_embedding)
+            if search_result:
+                log_requests_count(user_id, await async_user_requests_dao.update_user_requests_count(user_id))
+            else:
+                logger.info(f"Search process was rejected for user {user_id}")
+        finally:
+            # no stage outlives the update, the shared embedding included when the quota check raised
+            abandoned = True
+            log_task_error(typing, "typing")
+            log_task_error(query_embedding, "embedding")
+            admission.release()
+    finally:
+        in_flight_requests.finish(ticket)
+
+
+async def run_search_async(chat_id, chat_text, is_cancelled=None, admission=None, query_embedding=None):
+    """Asyncio version of `run_search`, `query_embedding` is a task of `embed_query_shared_async`."""
+    preliminary_messages = []
+
+    async def send_preliminary_answer(answer):
+        try:
+            preliminary_messages.append(await async_bot.send_photo(
+                chat_id=chat_id,
+                photo=generate_random_image_url(),
+                caption=answer,
+                parse_mode=ParseMode.MARKDOWN
+            ))
+        except Exception as e:
+            logger.error(f"Preliminary answer was not sent: {e}")
+
+    async def search_once(call):
+        def cancelled():
+            return is_cancelled is not None and is_cancelled() and call.waiters == 0
+
+        return await search_async(chat_text, on_preliminary=send_preliminary_answer if PROGRESSIVE_REPLY else None,
+                                  is_cancelled=cancelled, embedding_task=query_embedding)
+
+    search_started = time.monotonic()
+    try:
+        while True:
+            try:
+                message = await async_single_flight.do(normalize_query(chat_text), search_once)
+                break
+            except SearchCancelled:
+                if is_cancelled is not None and is_cancelled():
+                    logger.info(f"Search for chat {chat_id} is cancelled by a newer message")
+                    return False
+                query_embedding = None
+        logger.info(message)
+        if admission is not None:
+            admission.record(search_started)
+    except Exception as e:
+        app.log.error(e)
+        app.log.error(traceback.format_exc())
+        if admission is not None:
+            admission.record(search_started, failed=True)
+        await send_service_unavailable_message_async(chat_id)
+        return False
+    else:
+        if preliminary_messages:
+            await async_bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=preliminary_messages[0]['message_id'],
+                caption=message,
+                parse_mode=ParseMode.MARKDOWN
+            )
+        else:
+            await async_bot.send_photo(
+                chat_id=chat_id,
+                photo=generate_random_image_url(),
+                caption=message,
+                parse_mode=ParseMode.MARKDOWN
+            )
+        return True
+
+
 #####################
 # Commands #
 #####################
@@ -255,24 +630,159 @@ def wakeup(event, context):
     return Response(body='Message sent successfully', status_code=200)
 
 
-@app.lambda_function(name=MESSAGE_HANDLER_LAMBDA)
-def message_handler(event, context):
-    is_service_available = SERVICE_AVAILABLE.lower() == "true"
+def register_handlers():
     dispatcher.add_handler(CommandHandler("start", start_command))
     dispatcher.add_handler(CommandHandler("help", help_command))
+    dispatcher.add_handler(MessageHandler(Filters.text, process_message))
+    # dispatcher.add_handler(MessageHandler(Filters.voice, process_voice_message))
+
+
+register_handlers()
+
+# the dispatcher only logs the errors of handlers, they are kept here to fail the update
+handler_error = contextvars.ContextVar("handler_error", default=None)
+
 
-    def service_unavailable_message(update, _context):
-        return send_service_unavailable_message(update.message.chat_id, _context)
+def record_handler_error(update, context):
+    handler_error.set(context.error)
 
-    if is_service_available:
-        dispatcher.add_handler(MessageHandler(Filters.text, process_message))
-        # dispatcher.add_handler(MessageHandler(Filters.voice, process_voice_message))
+
+dispatcher.add_error_handler(record_handler_error)
+
+
+def dispatch(update):
+    """Runs the handlers of the update and raises the error of a failed handler."""
+    token = handler_error.set(None)
+    try:
+        dispatcher.process_update(update)
+        error = handler_error.get()
+    finally:
+        handler_error.reset(token)
+    if error is not None:
+        raise error
+
+
+def announce_update(update_json):
+    message = update_json.get('message') or {}
+    text = message.get('text')
+    user_id = (message.get('from') or {}).get('id')
+    if text and not text.startswith('/') and user_id is not None:
+        in_flight_requests.announce(user_id, update_json['update_id'])
+
+
+def log_failure_after_side_effects(update_id, error):
+    # the user got a reply or was charged already, a re-delivery would do it again
+    logger.opt(exception=error).error(f"Update {update_id} failed after its replies started, it is not retried")
+
+
+def process_update(update_json):
+    update_id = update_json.get("update_id")
+    with tracer.trace(update_id):
+        # Telegram re-delivers updates we were slow to acknowledge, each one must run only once
+        if not update_deduplicator.claim(update_id):
+            return
+        with tracking_side_effects() as side_effects:
+            try:
+                dispatch(Update.de_json(update_json, bot))
+            except Exception as e:
+                if not side_effects.is_set():
+                    # the re-delivery of the update is processed again
+                    update_deduplicator.release(update_id)
+                    raise
+                log_failure_after_side_effects(update_id, e)
+        update_deduplicator.complete(update_id)
+
+
+async def process_update_async(update_json):
+    update_id = update_json.get("update_id")
+    with tracer.trace(update_id):
+        if not await asyncio.to_thread(update_deduplicator.claim, update_id):
+            return
+        with tracking_side_effects() as side_effects:
+            try:
+                update = Update.de_json(update_json, bot)
+                message = update.message
+                if message is not None and message.text and not message.text.startswith('/'):
+                    await process_message_async(update)
+                else:
+                    # commands are rare, they keep running on the dispatcher
+                    await asyncio.to_thread(dispatch, update)
+            except Exception as e:
+                if not side_effects.is_set():
+                    await asyncio.to_thread(update_deduplicator.release, update_id)
+                    raise
+                log_failure_after_side_effects(update_id, e)
+        await asyncio.to_thread(update_deduplicator.complete, update_id)
+
+
+def handle_update(update_json):
+    """Processes one update in the configured execution mode."""
+    if event_loop is not None:
+        event_loop.run(process_update_async(update_json))
     else:
-        dispatcher.add_handler(MessageHandler(Filters.text, service_unavailable_message))
-        # dispatcher.add_handler(MessageHandler(Filters.voice, service_unavailable_message))
+        process_update(update_json)
+
+
+def process_batch_on_loop(updates, process_update_coroutine, max_concurrency):
+    return event_loop.run(process_batch_async(updates, process_update_coroutine, max_concurrency))
+
 
+def process_updates(updates):
+    """Processes a batch of updates in the configured execution mode, returns the failed ones."""
+    if event_loop is not None:
+        return process_batch_on_loop(updates, process_update_async, WORKER_CONCURRENCY)
+    return process_batch(updates, process_update, WORKER_CONCURRENCY)
+
+
+def warm_up():
+    """Loads the indexes and caches and opens the connections before the first update arrives."""
+    get_text_search()
+    get_cached_results("")
+    service_switch.is_on()
+    bot.get_me()
+
+
+def create_update_queue():
+    if UPDATES_QUEUE:
+        return SqsUpdateQueue(UPDATES_QUEUE)
+    if STAGE == Stage.LOCAL:
+        update_queue = InMemoryUpdateQueue()
+        if event_loop is not None:
+            LocalUpdateWorker(update_queue, process_update_async, WORKER_BATCH_SIZE, WORKER_CONCURRENCY,
+                              process_batch=process_batch_on_loop).start()
+        else:
+            LocalUpdateWorker(update_queue, process_update, WORKER_BATCH_SIZE, WORKER_CONCURRENCY).start()
+        return update_queue
+    raise RuntimeError("UPDATES_QUEUE must be set to process updates in the queue mode")
+
+
+update_queue = create_update_queue() if PROCESSING_MODE == ProcessingMode.QUEUE else None
+
+
+@app.lambda_function(name=MESSAGE_HANDLER_LAMBDA)
+def message_handler(event, context):
     try:
-        dispatcher.process_update(Update.de_json(json.loads(event["body"]), bot))
+        update_json = json.loads(event["body"])
+    except (KeyError, TypeError, ValueError) as e:
+        # Telegram retries every non-2xx response, a body that cannot be read would come back forever
+        logger.error(f"Unreadable update is ignored: {e}")
+        return {"statusCode": 200}
+
+    if not is_valid_update(update_json):
+        logger.warning(f"Unsupported update is ignored: {update_json}")
+        return {"statusCode": 200}
+    announce_update(update_json)
+
+    if update_queue is not None:
+        try:
+            update_queue.enqueue(update_json)
+        except Exception as e:
+            logger.error(e)
+            return {"statusCode": 500}
+        return {"statusCode": 200}
+
+    try:
+        handle_update(update_json)
     except Exception as e:
         logger.error(e)
         return {"statusCode": 500}
@@ -280,6 +790,18 @@ def message_handler(event, context):
     return {"statusCode": 200}
 
 
+if UPDATES_QUEUE:
+    @app.on_sqs_message(queue=UPDATES_QUEUE, batch_size=WORKER_BATCH_SIZE, name=UPDATE_WORKER_LAMBDA)
+    def update_worker(event):
+        updates = [json.loads(record.body) for record in event]
+        for update_json in updates:
+            announce_update(update_json)
+        failed = process_updates(updates)
+        if failed:
+            # the whole batch is redelivered by SQS
+            raise RuntimeError(f"{len(failed)} of {len(updates)} updates failed")
+
+
 logger.info(f"STAGE: {STAGE}")
 if STAGE == Stage.LOCAL:
     @app.route('/', methods=['POST'], content_types=['application/json'])
@@ -0,0 +1,141 @@
+"""Recall, memory and latency of the ANN index against an exact scan on a growing corpus.
+
+Run from the repository root:
+
+    python -m benchmarks.ann_benchmark
+    python -m benchmarks.ann_benchmark --scales 1,10 --nprobe 8,32 --rerank 2,8
+
+The fixture corpus is copied `scale` times with a little noise added to every copy, so the archive
+grows while keeping its clusters. Queries are the fixture questions plus noisy corpus vectors.
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import numpy as np
+from loguru import logger
+
+from benchmarks.fakes import build_vocabulary, generate_corpus, hashing_embedding
+from chalicelib.ann_index import IvfNamespace
+from chalicelib.tracing import nearest_rank
+from chalicelib.utils import get_list
+
+QUERIES_PATH = "benchmarks/fixtures/queries.json"
+
+
+def normalized(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def scaled_vectors(base, scale, noise, rng):
+    vectors = np.empty((len(base) * scale, base.shape[1]), dtype=np.float32)
+    vectors[:len(base)] = base
+    for copy in range(1, scale):
+        shifted = base + noise * rng.standard_normal(base.shape, dtype=np.float32)
+        vectors[copy * len(base):(copy + 1) * len(base)] = normalized(shifted)
+    return vectors
+
+
+def exact_search(vectors, query, top_k):
+    scores = vectors @ query
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def latency_summary(latencies):
+    ordered = sorted(latencies)
+    return nearest_rank(ordered, 50), nearest_rank(ordered, 95)
+
+
+def benchmark_scale(base, queries, scale, top_k, nprobes, reranks, noise, seed):
+    rng = np.random.default_rng(seed)
+    vectors = scaled_vectors(base, scale, noise, rng)
+
+    start = time.perf_counter()
+    namespace = IvfNamespace.build([str(position) for position in range(len(vectors))], vectors,
+                                   [{}] * len(vectors))
+    build_seconds = time.perf_counter() - start
+
+    exact_latencies, expected = [], []
+    for query in queries:
+        start = time.perf_counter()
+        expected.append(set(exact_search(vectors, query, top_k).tolist()))
+        exact_latencies.append((time.perf_counter() - start) * 1000)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        namespace.save(path)
+        del namespace
+        mapped = IvfNamespace.load(path)
+        memory = mapped.memory_bytes()
+        for nprobe in nprobes:
+            for rerank in reranks:
+                latencies, recalls = [], []
+                for query, exact_ids in zip(queries, expected):
+                    start = time.perf_counter()
+                    positions, _ = mapped.query(query, top_k, nprobe, rerank)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    found = {int(mapped.ids[position]) for position in positions}
+                    recalls.append(len(found & exact_ids) / len(exact_ids))
+                rows.append((nprobe, rerank, float(np.mean(recalls)), *latency_summary(latencies)))
+
+    return {
+        'vectors': len(vectors),
+        'lists': len(mapped.offsets) - 1,
+        'build_seconds': build_seconds,
+        'exact_mb': vectors.nbytes / 2 ** 20,
+        'quantized_mb': memory['quantized'] / 2 ** 20,
+        'full_precision_mb': memory['full_precision'] / 2 ** 20,
+        'exact_latency': latency_summary(exact_latencies),
+        'rows': rows,
+    }
+
+
+def print_report(scale, report, top_k):
+    print(f"\nscale {scale}: {report['vectors']} vectors, {report['lists']} lists, built in "
+          f"{report['build_seconds']:.1f} s")
+    print(f"exact scan: {report['exact_mb']:.1f} MB in memory, p50 {report['exact_latency'][0]:.2f} ms, "
+          f"p95 {report['exact_latency'][1]:.2f} ms")
+    print(f"ann: {report['quantized_mb']:.1f} MB of int8 codes scanned, "
+          f"{report['full_precision_mb']:.1f} MB of mapped vectors for re-ranking")
+    print(f"{'nprobe':>8}{'rerank':>8}{f'recall@{top_k}':>12}{'p50 ms':>10}{'p95 ms':>10}")
+    for nprobe, rerank, recall, p50, p95 in report['rows']:
+        print(f"{nprobe:>8}{rerank:>8}{recall:>12.3f}{p50:>10.2f}{p95:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", default=QUERIES_PATH)
+    parser.add_argument("--namespace", default="text", choices=["text", "meaning"])
+    parser.add_argument("--scales", default="1,10,100")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nprobe", default="4,16,64", help="lists probed per query")
+    parser.add_argument("--rerank", default="4", help="candidates re-ranked per result")
+    parser.add_argument("--query-count", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.05, help="noise added to the copies of the corpus")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    questions = get_list(args.queries)
+    corpus = generate_corpus(build_vocabulary(questions))
+    base = np.array([record['values'] for record in corpus[args.namespace]], dtype=np.float32)
+
+    rng = np.random.default_rng(args.seed)
+    queries = [np.array(hashing_embedding(question)[0], dtype=np.float32) for question in questions]
+    sampled = base[rng.integers(0, len(base), max(0, args.query_count - len(queries)))]
+    queries.extend(normalized(sampled + 0.3 * rng.standard_normal(sampled.shape, dtype=np.float32)))
+
+    nprobes = [int(value) for value in args.nprobe.split(",")]
+    reranks = [int(value) for value in args.rerank.split(",")]
+    for scale in [int(value) for value in args.scales.split(",")]:
+        report = benchmark_scale(base, queries, scale, args.top_k, nprobes, reranks, args.noise, args.seed)
+        print_report(scale, report, args.top_k)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+import asyncio
+import csv
+import hashlib
+import itertools
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from chalicelib.ingestion import meaning_record_id, text_record_id
+from chalicelib.local_index import LocalIndex
+from chalicelib.utils import extract_video_id
+
+TITLES_PATH = "chalicelib/cache/youtube_titles.csv"
+EMBEDDING_DIMENSION = 256
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+def hashing_embedding(text, dimension=EMBEDDING_DIMENSION):
+    """Deterministic stand-in for the OpenAI embedding: a normalized feature-hashed bag of words."""
+    vector = np.zeros(dimension, dtype=np.float32)
+    tokens = tokenize(text)
+    for token in tokens:
+        digest = hashlib.md5(token.encode()).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dimension
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector.tolist(), len(tokens)
+
+
+class FakeEmbeddings:
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return hashing_embedding(text)
+
+    async def embed_async(self, text):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return hashing_embedding(text)
+
+    def batch(self, texts):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        embeddings = [hashing_embedding(text) for text in texts]
+        return [vector for vector, _ in embeddings], sum(tokens for _, tokens in embeddings)
+
+
+class FakeTranslator:
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000
+        self.calls = 0
+
+    def __call__(self, text, src, target):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return text
+
+    async def translate_async(self, text, src, target):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return text
+
+
+class FakeIndex(LocalIndex):
+    """LocalIndex preloaded with fixture namespaces that can emulate the latency of a remote index."""
+
+    def __init__(self, namespaces, latency_ms=0.0):
+        super().__init__()
+        self.latency = latency_ms / 1000
+        for namespace, records in namespaces.items():
+            self.upsert(records, namespace=namespace)
+
+    def query(self, *args, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return super().query(*args, **kwargs)
+
+
+def load_videos(path=TITLES_PATH):
+    videos = []
+    with open(path, 'r') as csv_file:
+        for row in csv.DictReader(csv_file):
+            video_id = extract_video_id(row['Ссылка на видео в YouTube'])
+            if video_id:
+                videos.append({
+                    'video_id': video_id,
+                    'title': row['Заголовок'],
+                    'subtitle': row['Подзаголовок'],
+                    'published': row['Дата выпуска'],
+                })
+    return videos
+
+
+def generate_corpus(vocabulary, seed=13, meanings_per_video=12, texts_per_meaning=4, words_per_text=60,
+                    videos=None, scale=1):
+    """Build synthetic "text" and "meaning" namespaces shaped like the production index.
+
+    Every video from the titles listing gets `meanings_per_video` meaning segments and each of them
+    `texts_per_meaning` text chunks, with ids and metadata following the production layout.
+    `scale` repeats the listing with suffixed ids to emulate a larger archive.
+    """
+    rng = random.Random(seed)
+    videos = videos if videos is not None else load_videos()
+    texts, meanings = [], []
+
+    for copy in range(scale):
+        for video in videos:
+            video_id = video['video_id'] if copy == 0 else f"{video['video_id']}x{copy}"
+            title_words = tokenize(video['subtitle'])
+            published = video['published'] or (date(2020, 1, 1) + timedelta(days=rng.randrange(1000))).isoformat()
+            for meaning_number in range(meanings_per_video):
+                meaning_start = meaning_number * 300
+                meaning_id = meaning_record_id(video_id, meaning_start)
+                topic = rng.sample(vocabulary, 8) + title_words
+                meaning_words = []
+                for text_number in range(texts_per_meaning):
+                    start = meaning_start + text_number * 75
+                    words = [rng.choice(topic) if rng.random() < 0.5 else rng.choice(vocabulary)
+                             for _ in range(words_per_text)]
+                    meaning_words.extend(words)
+                    text = " ".join(words)
+                    texts.append({
+                        'id': text_record_id(video_id, start),
+                        'values': hashing_embedding(text)[0],
+                        'metadata': {
+                            'meaning_id': meaning_id,
+                            'text': text,
+                            'title': f"{video['title']} - Даниил Зуев расскажет",
+                            'url': f"https://www.youtube.com/watch?v={video_id}",
+                            'start': float(start),
+                            'published': published,
+                        },
+                    })
+                meanings.append({
+                    'id': meaning_id,
+                    'values': hashing_embedding(" ".join(meaning_words))[0],
+                    'metadata': {'video_id': video_id, 'start': float(meaning_start)},
+                })
+
+    return {'text': texts, 'meaning': meanings}
+
+
+def build_vocabulary(queries, videos=None):
+    videos = videos if videos is not None else load_videos()
+    words = set()
+    for video in videos:
+        words.update(tokenize(video['subtitle']))
+    for query in queries:
+        words.update(tokenize(query))
+    return sorted(word for word in words if len(word) > 2)
+
+
+class FakeTelegramRequest:
+    """Replaces telegram.utils.request.Request so that a real Bot talks to a local Telegram stand-in.
+
+    `request_async` does the same for the asyncio bot.
+    """
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000
+        self.calls = defaultdict(int)
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._updates = []
+        self._updates_ready = threading.Condition()
+
+    def _message(self, data):
+        message = {
+            'message_id': data.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': data['chat_id'], 'type': 'private'},
+        }
+        if 'text' in data:
+            message['text'] = data['text']
+        if 'caption' in data:
+            message['caption'] = data['caption']
+        return message
+
+    def post(self, url, data, timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self._respond(endpoint, data)
+
+    async def request_async(self, method, data):
+        """Stands in for AsyncTelegramBot.request."""
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(method, data)
+
+    def _respond(self, endpoint, data):
+        if endpoint in ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption'):
+            return self._message(data)
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        if endpoint == 'getUpdates':
+            return self._get_updates(data)
+        return True
+
+    def push_update(self, update_json):
+        """Queues an update for getUpdates, the returned event is set once the bot confirms it."""
+        confirmed = threading.Event()
+        with self._updates_ready:
+            self._updates.append((update_json, confirmed))
+            self._updates_ready.notify_all()
+        return confirmed
+
+    def _get_updates(self, data):
+        offset = data.get('offset', 0)
+        with self._updates_ready:
+            pending = []
+            for update_json, confirmed in self._updates:
+                if update_json['update_id'] < offset:
+                    confirmed.set()
+                else:
+                    pending.append((update_json, confirmed))
+            self._updates = pending
+            if not self._updates and data.get('timeout'):
+                self._updates_ready.wait(data['timeout'])
+            updates = sorted((update_json for update_json, _ in self._updates), key=lambda item: item['update_id'])
+            return updates[:data.get('limit', 100)]
+
+    def stop(self):
+        pass
+
+
+class InMemoryTable:
+    """Subset of the boto3 DynamoDB Table API used by the DAOs, kept in a dict."""
+
+    SET_ASSIGNMENT_RE = re.compile(
+        r"(\w+)\s*=\s*(?:if_not_exists\(\s*\w+\s*,\s*(:\w+)\s*\)\s*\+\s*(:\w+)|(:\w+))")
+    REMOVE_RE = re.compile(r"REMOVE\s+(\w+(?:\s*,\s*\w+)*)")
+
+    def __init__(self, key_name='user_id', latency_ms=0.0):
+        self.key_name = key_name
+        self.latency = latency_ms / 1000
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_item(self, Key, **kwargs):
+        self._wait()
+        with self._lock:
+            item = self.items.get(Key[self.key_name])
+            return {'Item': dict(item)} if item is not None else {}
+
+    @staticmethod
+    def _condition_holds(item, expression, values):
+        """Evaluates `attribute_not_exists(...)`, `name < :value` and `name = :value` clauses joined with OR."""
+        for clause in expression.split(" OR "):
+            if clause.strip().startswith("attribute_not_exists"):
+                if item is None:
+                    return True
+            else:
+                name, operator, value = clause.split()
+                if item is None or name not in item:
+                    continue
+                if operator == '<' and item[name] < values[value] or operator == '=' and item[name] == values[value]:
+                    return True
+        return False
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self._wait()
+        with self._lock:
+            key = Item[self.key_name]
+            if ConditionExpression and not self._condition_holds(self.items.get(key), ConditionExpression,
+                                                                 ExpressionAttributeValues or {}):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'PutItem')
+            self.items[key] = dict(Item)
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self._wait()
+        with self._lock:
+            self.items.pop(Key[self.key_name], None)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues=None, **kwargs):
+        self._wait()
+        with self._lock:
+            key = Key[self.key_name]
+            item = self.items.setdefault(key, {self.key_name: key})
+            for name, start, increment, value in self.SET_ASSIGNMENT_RE.findall(UpdateExpression):
+                if value:
+                    item[name] = ExpressionAttributeValues[value]
+                else:
+                    item[name] = item.get(name, ExpressionAttributeValues[start]) + ExpressionAttributeValues[increment]
+            for names in self.REMOVE_RE.findall(UpdateExpression):
+                for name in names.split(","):
+                    item.pop(name.strip(), None)
+            return {'Attributes': dict(item)} if ReturnValues else {}
+
+    def scan(self, **kwargs):
+        self._wait()
+        with self._lock:
+            return {'Items': [dict(item) for item in self.items.values()]}
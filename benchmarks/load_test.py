@@ -0,0 +1,255 @@
+"""Load test of the webhook message handler with every outbound dependency replaced by a local stand-in.
+
+Run from the repository root:
+
+    python -m benchmarks.load_test --rate 20 --concurrency 8 --duration 10
+    python -m benchmarks.load_test --target route --concurrency 16
+    python -m benchmarks.load_test --processing-mode queue --rate 50
+    python -m benchmarks.load_test --execution-mode asyncio --concurrency 64
+    python -m benchmarks.load_test --target polling --concurrency 64
+
+In the queue mode the latency percentiles are webhook acknowledgement times and the throughput
+counts updates that were fully processed by the worker within the round.
+With the polling target the updates are served by the fake getUpdates to the long-polling worker,
+the latency lasts until the worker confirms the update, which is the poll after the one that
+fetched it, not the end of its processing.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from loguru import logger
+
+from benchmarks.fakes import FakeEmbeddings, FakeTelegramRequest, FakeTranslator, InMemoryTable
+from benchmarks.search_benchmark import QUERIES_PATH, build_text_search
+from chalicelib.polling import LongPollingWorker
+from chalicelib.tracing import Histogram, traced, tracer
+from chalicelib.utils import get_list
+
+FAKE_ENVIRONMENT = {
+    "TELEGRAM_TOKEN": "123456:load-test-token",
+    "OPENAI_API_KEY": "load-test",
+    "SERVICE_AVAILABLE": "true",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}
+
+
+def load_app(target, processing_mode, execution_mode="threads"):
+    for name, value in FAKE_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    # the in-memory update queue and its worker only exist in the local stage
+    local = target == "route" or processing_mode == "queue"
+    os.environ["STAGE"] = "local" if local else os.environ.get("STAGE", "dev")
+    os.environ["PROCESSING_MODE"] = processing_mode
+    os.environ["EXECUTION_MODE"] = execution_mode
+    os.environ.pop("UPDATES_QUEUE", None)
+    import app
+    return app
+
+
+class SyntheticUpdates:
+    def __init__(self, queries, users, seed=7):
+        self.queries = queries
+        self.users = users
+        self.rng = random.Random(seed)
+        self.update_ids = itertools.count(100000)
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            update_id = next(self.update_ids)
+            user_id = 1000 + self.rng.randrange(self.users)
+            text = self.rng.choice(self.queries)
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'language_code': 'ru'}
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private', 'first_name': 'Load'},
+                'from': user,
+                'text': text,
+            },
+        }
+
+
+class LoadTest:
+    def __init__(self, app_module, target, rate, concurrency, users, queries, telegram=None):
+        self.app = app_module
+        self.target = target
+        self.rate = rate
+        self.concurrency = concurrency
+        self.updates = SyntheticUpdates(queries, users)
+        self.telegram = telegram
+        self.gateway = None
+        self.worker = None
+        if target == "route":
+            from chalice.config import Config
+            from chalice.local import LocalGateway
+            self.gateway = LocalGateway(app_module.app, Config())
+        if target == "polling":
+            self.worker = LongPollingWorker(app_module.bot, app_module.handle_update, app_module.announce_update,
+                                            app_module.WORKER_CONCURRENCY, poll_timeout=1)
+            self.worker_thread = threading.Thread(target=self.worker.run, daemon=True)
+            self.worker_thread.start()
+
+    def stop(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker_thread.join()
+
+    def send(self, update):
+        if self.worker is not None:
+            return 200 if self.telegram.push_update(update).wait(60) else "timeout"
+        body = json.dumps(update)
+        if self.gateway is not None:
+            response = self.gateway.handle_request(method='POST', path='/', body=body.encode(),
+                                                   headers={'content-type': 'application/json'})
+            return json.loads(response['body']).get('statusCode', response['statusCode'])
+        return self.app.message_handler({"body": body}, None)["statusCode"]
+
+    def timed_send(self, update, latencies, statuses, lock):
+        start = time.perf_counter()
+        try:
+            status = self.send(update)
+        except Exception as e:
+            logger.error(e)
+            status = "error"
+        latencies.record((time.perf_counter() - start) * 1000)
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def run_round(self, duration):
+        latencies = Histogram(size=100000)
+        statuses = {}
+        lock = threading.Lock()
+        max_threads = threading.active_count()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = []
+            sent = 0
+            while time.perf_counter() - start < duration:
+                if self.rate:
+                    # open loop: keep the configured arrival rate regardless of response times
+                    next_at = start + sent / self.rate
+                    delay = next_at - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                else:
+                    # closed loop: never keep more than `concurrency` updates in flight
+                    pending = [future for future in pending if not future.done()]
+                    if len(pending) >= self.concurrency:
+                        time.sleep(0.001)
+                        continue
+                pending.append(executor.submit(self.timed_send, self.updates.next(), latencies, statuses, lock))
+                sent += 1
+                max_threads = max(max_threads, threading.active_count())
+        if self.app.update_queue is not None:
+            # acknowledged updates still have to be processed by the local worker
+            self.app.update_queue.join()
+        elapsed = time.perf_counter() - start
+
+        summary = latencies.summary()
+        return {
+            'sent': sent,
+            'throughput': summary['count'] / elapsed,
+            'latency': summary,
+            'statuses': statuses,
+            'max_threads': max_threads,
+            'threads_after': threading.active_count(),
+        }
+
+
+def install_fakes(app_module, args, queries):
+    telegram = FakeTelegramRequest(args.telegram_latency_ms)
+    app_module.bot._request = telegram
+    app_module.async_bot.request = telegram.request_async
+    app_module.user_requests_dao.table = InMemoryTable(latency_ms=args.dynamodb_latency_ms)
+    app_module.user_analytics_dao.table = InMemoryTable(latency_ms=args.dynamodb_latency_ms)
+    app_module.processed_updates_dao.table = InMemoryTable('update_id', latency_ms=args.dynamodb_latency_ms)
+    app_module.service_state_dao.table = InMemoryTable('service', latency_ms=args.dynamodb_latency_ms)
+
+    from chalicelib import search as search_module
+    search_module.set_text_search(build_text_search(queries, index_latency_ms=args.index_latency_ms))
+
+    patches = [
+        patch.object(search_module, "google_translate", traced("translate")(FakeTranslator(args.api_latency_ms))),
+        patch.object(search_module, "generate_embedding", traced("embed")(FakeEmbeddings(args.api_latency_ms))),
+        patch.object(search_module, "async_google_translate",
+                     traced("translate")(FakeTranslator(args.api_latency_ms).translate_async)),
+        patch.object(search_module, "async_generate_embedding",
+                     traced("embed")(FakeEmbeddings(args.api_latency_ms).embed_async)),
+        patch.object(app_module, "generate_random_image_url", lambda: "https://example.com/photo.jpg"),
+        # stage histograms are reported at the end instead of printing an EMF line per update
+        patch.object(tracer, "emit", lambda line: None),
+    ]
+    for fake in patches:
+        fake.start()
+    return telegram, patches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", choices=["handler", "route", "polling"], default="handler",
+                        help="call message_handler directly, go through the local '/' route or serve getUpdates "
+                             "to the long-polling worker")
+    parser.add_argument("--processing-mode", choices=["sync", "queue"], default="sync",
+                        help="process updates in the webhook or acknowledge them and use the local queue worker")
+    parser.add_argument("--execution-mode", choices=["threads", "asyncio"], default="threads",
+                        help="run the handlers on threads or as coroutines on one event loop")
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 for a closed loop")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per round")
+    parser.add_argument("--rounds", type=int, default=3, help="warm invocation rounds in one container")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--queries", default=QUERIES_PATH)
+    parser.add_argument("--telegram-latency-ms", type=float, default=50)
+    parser.add_argument("--dynamodb-latency-ms", type=float, default=5)
+    parser.add_argument("--api-latency-ms", type=float, default=100)
+    parser.add_argument("--index-latency-ms", type=float, default=50)
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+
+    queries = get_list(args.queries)
+    app_module = load_app(args.target, args.processing_mode, args.execution_mode)
+    telegram, patches = install_fakes(app_module, args, queries)
+    load_test = LoadTest(app_module, args.target, args.rate, args.concurrency, args.users, queries, telegram)
+
+    tracemalloc.start()
+    baseline_memory, _ = tracemalloc.get_traced_memory()
+    print(f"{'round':<7}{'sent':>7}{'upd/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'threads':>9}"
+          f"{'after':>7}{'mem MB':>9}  statuses")
+    try:
+        for round_number in range(1, args.rounds + 1):
+            result = load_test.run_round(args.duration)
+            memory, _ = tracemalloc.get_traced_memory()
+            latency = result['latency']
+            print(f"{round_number:<7}{result['sent']:>7}{result['throughput']:>8.1f}{latency.get('p50', 0):>9.0f}"
+                  f"{latency.get('p95', 0):>9.0f}{latency.get('p99', 0):>9.0f}{result['max_threads']:>9}"
+                  f"{result['threads_after']:>7}{(memory - baseline_memory) / 2 ** 20:>9.2f}  {result['statuses']}")
+    finally:
+        load_test.stop()
+        tracemalloc.stop()
+        for fake in patches:
+            fake.stop()
+
+    print(f"Telegram calls: {dict(telegram.calls)}")
+    print(f"{'stage':<40}{'count':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for stage, summary in sorted(tracer.snapshot().items()):
+        print(f"{stage:<40}{summary['count']:>8}{summary['p50']:>9.1f}{summary['p95']:>9.1f}{summary['p99']:>9.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
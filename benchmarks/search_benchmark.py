@@ -0,0 +1,180 @@
+"""Offline benchmark of chalicelib.search against deterministic fake backends.
+
+Run from the repository root:
+
+    python -m benchmarks.search_benchmark
+    python -m benchmarks.search_benchmark --update-baseline
+    python -m benchmarks.search_benchmark --lexical
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from loguru import logger
+
+from benchmarks.fakes import FakeEmbeddings, FakeIndex, FakeTranslator, build_vocabulary, generate_corpus
+from chalicelib import search as search_module
+from chalicelib.lexical_index import LexicalIndex
+from chalicelib.search import TextSearch
+from chalicelib.tracing import traced, tracer
+from chalicelib.utils import get_list
+
+QUERIES_PATH = "benchmarks/fixtures/queries.json"
+BASELINE_PATH = "benchmarks/baseline.json"
+REPORTED_STAGES = ["search", "translate", "embed", "index.lexical_query", "index.text_query", "index.meaning_query",
+                   "ranking", "dedupe", "render"]
+
+
+def build_lexical_index(texts):
+    return LexicalIndex.build({'id': text['id'], 'text': text['metadata']['text'], 'title': text['metadata']['title'],
+                               'metadata': text['metadata']} for text in texts)
+
+
+def build_text_search(queries, index_latency_ms=0.0, scale=1, lexical=False):
+    corpus = generate_corpus(build_vocabulary(queries), scale=scale)
+    index = FakeIndex(corpus, latency_ms=index_latency_ms)
+    lexical_index = build_lexical_index(corpus['text']) if lexical else None
+    return TextSearch(index=index, titles=TextSearch.load_titles(), lexical_index=lexical_index)
+
+
+def ranking_peak_kib(text_search, embedding):
+    """Peak memory allocated by ranking, deduplication and describing the hits of one query."""
+    texts = text_search.query_texts(embedding, 20)
+    meanings = text_search.query_meanings(embedding, 1600)
+    tracemalloc.start()
+    try:
+        text_search.describe(text_search.top_per_video(text_search.order_by_joint_relevance(texts, meanings), 3))
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(queries, repeat=5, warmup=2, index_latency_ms=0.0, api_latency_ms=0.0, scale=1, lexical=False):
+    text_search = build_text_search(queries, index_latency_ms, scale, lexical)
+    embeddings = FakeEmbeddings(api_latency_ms)
+    translator = FakeTranslator(api_latency_ms)
+
+    with patch.object(search_module, "google_translate", traced("translate")(translator)), \
+            patch.object(search_module, "generate_embedding", traced("embed")(embeddings)), \
+            patch.object(tracer, "sample_rate", 1.0):
+        search_module.set_text_search(text_search)
+        for query in queries[:warmup]:
+            search_module.search(query)
+
+        # every repeat is summarized on its own, the report takes the median of each statistic
+        snapshots = []
+        elapsed = 0.0
+        for _ in range(repeat):
+            tracer.reset()
+            start = time.perf_counter()
+            for query in queries:
+                search_module.search(query)
+            elapsed += time.perf_counter() - start
+            snapshots.append(tracer.snapshot())
+        stages = median_stages(snapshots)
+
+        results = {}
+        ranking_peaks = []
+        for query in queries:
+            embedding, _ = embeddings(translator(query, "ru", "en"))
+            results[query] = [hit.id for hit in text_search.search(embedding, 3, query=query)]
+            ranking_peaks.append(ranking_peak_kib(text_search, embedding))
+        tracer.reset()
+
+    return {
+        'queries': len(queries) * repeat,
+        'throughput_qps': len(queries) * repeat / elapsed,
+        'ranking_peak_kib': sum(ranking_peaks) / len(ranking_peaks),
+        'stages': {stage: stages[stage] for stage in REPORTED_STAGES if stage in stages},
+        'results': results,
+    }
+
+
+def median_stages(snapshots):
+    stages = {}
+    for stage in {stage for snapshot in snapshots for stage in snapshot}:
+        summaries = [snapshot[stage] for snapshot in snapshots if snapshot.get(stage, {}).get('count')]
+        stages[stage] = {key: statistics.median(summary[key] for summary in summaries)
+                         for key in ('mean', 'p50', 'p95', 'p99', 'max')}
+        stages[stage]['count'] = sum(summary['count'] for summary in summaries)
+    return stages
+
+
+def compare_with_baseline(report, baseline, tolerance, min_delta_ms=5.0):
+    problems = []
+    for stage, summary in baseline['stages'].items():
+        current = report['stages'].get(stage)
+        if current is None:
+            continue
+        for percentile in ('p50', 'p95'):
+            allowed = max(summary[percentile] * (1 + tolerance), summary[percentile] + min_delta_ms)
+            if current[percentile] > allowed:
+                problems.append(f"{stage} {percentile}: {current[percentile]:.2f} ms > {allowed:.2f} ms allowed "
+                                f"(baseline {summary[percentile]:.2f} ms)")
+
+    for query, expected_ids in baseline['results'].items():
+        actual_ids = report['results'].get(query)
+        if actual_ids is not None and actual_ids != expected_ids:
+            problems.append(f"results changed for {query!r}: {actual_ids} != {expected_ids}")
+
+    return problems
+
+
+def print_report(report):
+    print(f"Queries: {report['queries']}, throughput: {report['throughput_qps']:.1f} queries/sec")
+    print(f"Ranking peak memory per query: {report['ranking_peak_kib']:.1f} KiB")
+    print(f"{'stage':<22}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, summary in report['stages'].items():
+        print(f"{stage:<22}{summary['count']:>8}{summary['p50']:>10.2f}{summary['p95']:>10.2f}"
+              f"{summary['p99']:>10.2f}{summary['max']:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", default=QUERIES_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5, help="runs over the queries, medians are reported")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative slowdown of p50/p95 per stage")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0,
+                        help="slowdowns below this absolute value are ignored, sub-millisecond stages are noise")
+    parser.add_argument("--index-latency-ms", type=float, default=0.0)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0)
+    parser.add_argument("--scale", type=int, default=1, help="multiply the fixture corpus size")
+    parser.add_argument("--lexical", action="store_true", help="use a lexical index built from the fixture corpus")
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    queries = get_list(args.queries)
+    report = run_benchmark(queries, repeat=args.repeat, index_latency_ms=args.index_latency_ms,
+                           api_latency_ms=args.api_latency_ms, scale=args.scale, lexical=args.lexical)
+    print_report(report)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline at {args.baseline}, run with --update-baseline to record one")
+        return 0
+
+    problems = compare_with_baseline(report, baseline, args.tolerance, args.min_delta_ms)
+    for problem in problems:
+        print(f"REGRESSION: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+from chalicelib.tracing import nearest_rank
+
+
+class Admission:
+    def __init__(self, controller, probe=False):
+        self.controller = controller
+        self.probe = probe
+        self.latency_ms = None
+        self.failed = False
+
+    def record(self, started, failed=False):
+        """Records the outcome of the search started at `started`, only recorded searches are samples."""
+        self.latency_ms = (time.monotonic() - started) * 1000
+        self.failed = failed
+
+    def release(self):
+        self.controller.release(self)
+
+
+class AdmissionController:
+    """Decides whether this container takes a new search.
+
+    Searches are rejected while too many of them are in flight, and for `cooldown_seconds` after
+    the error rate or the p95 latency of recent searches went over its limit. Only the search itself
+    is measured, requests that end before it, like quota denials, are no samples. After the cooldown
+    a single probe search is let through, its success closes the circuit again.
+    """
+
+    def __init__(self, max_in_flight=8, max_error_rate=0.5, max_p95_latency_ms=20000, window_seconds=60,
+                 cooldown_seconds=30, min_samples=5):
+        self.max_in_flight = max_in_flight
+        self.max_error_rate = max_error_rate
+        self.max_p95_latency_ms = max_p95_latency_ms
+        self.window_seconds = window_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.min_samples = min_samples
+        self.in_flight = 0
+        self.open_until = None
+        self.probe_in_flight = False
+        self._outcomes = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            self._outcomes.popleft()
+
+    def try_acquire(self):
+        """Returns an Admission to release when the search is over, or None if the search is shed."""
+        now = time.monotonic()
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                return None
+            probe = self.open_until is not None
+            if probe:
+                if now < self.open_until or self.probe_in_flight:
+                    return None
+                self.probe_in_flight = True
+            self.in_flight += 1
+            return Admission(self, probe)
+
+    def release(self, admission):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            if admission.probe:
+                self.probe_in_flight = False
+                if admission.latency_ms is None:
+                    # no search ran, the next admission is the probe
+                    return
+                if admission.failed:
+                    self.open_until = now + self.cooldown_seconds
+                else:
+                    logger.info("Searches are admitted again")
+                    self.open_until = None
+                    self._outcomes.clear()
+                return
+            if admission.latency_ms is None:
+                return
+
+            self._outcomes.append((now, admission.latency_ms, admission.failed))
+            self._trim(now)
+            reason = self._overload_reason()
+            if reason:
+                logger.warning(f"Searches are shed for {self.cooldown_seconds} seconds: {reason}")
+                self.open_until = now + self.cooldown_seconds
+
+    def _overload_reason(self):
+        if len(self._outcomes) < self.min_samples:
+            return None
+        error_rate = sum(failed for _, _, failed in self._outcomes) / len(self._outcomes)
+        if error_rate > self.max_error_rate:
+            return f"error rate {error_rate:.2f}"
+        p95 = nearest_rank(sorted(latency for _, latency, _ in self._outcomes), 95)
+        if p95 > self.max_p95_latency_ms:
+            return f"p95 latency {p95:.0f} ms"
+        return None
+
+
+class ServiceSwitch:
+    """Manual on/off switch of the search shared by all containers through DynamoDB."""
+
+    def __init__(self, service_state_dao, default_available=True, ttl_seconds=30):
+        self.service_state_dao = service_state_dao
+        self.default_available = default_available
+        self.ttl_seconds = ttl_seconds
+        self._available = default_available
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def is_on(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._expires_at:
+                return self._available
+            self._expires_at = now + self.ttl_seconds
+        available = self.service_state_dao.is_available("search")
+        with self._lock:
+            self._available = self.default_available if available is None else available
+            return self._available
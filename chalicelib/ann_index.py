@@ -0,0 +1,222 @@
+"""Self-hosted approximate nearest neighbour index for the "text" and "meaning" namespaces.
+
+Built offline from a local index written by the ingestion, run from the repository root:
+
+    python -m chalicelib.ann_index --local-index .local_index --output chalicelib/cache/vector_index
+
+Every namespace is an inverted file: vectors are clustered around `lists_count` centroids and a
+query scans only the lists of the `nprobe` closest centroids. The scan uses int8 codes, the best
+`rerank * top_k` candidates are re-scored with the full-precision vectors. All arrays are
+memory-mapped, so only the probed lists are read.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+import numpy as np
+from loguru import logger
+
+from chalicelib.local_index import LocalIndex, matches_filter
+
+ASSIGN_BATCH_SIZE = 65536
+
+
+def assign_to_centroids(vectors, centroids):
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        batch = np.asarray(vectors[start:start + ASSIGN_BATCH_SIZE], dtype=np.float32)
+        assignments[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, lists_count, iterations=10, sample_per_list=64, seed=0):
+    """Spherical k-means on a sample of the vectors."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), lists_count * sample_per_list)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, lists_count, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = assign_to_centroids(sample, centroids)
+        order = np.argsort(assignments, kind='stable')
+        lists, starts = np.unique(assignments[order], return_index=True)
+        # empty lists keep their centroid
+        centroids[lists] = np.add.reduceat(sample[order], starts)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.where(norms > 0, norms, 1)
+    return centroids
+
+
+def quantize(vectors):
+    """Symmetric int8 codes with one scale per vector."""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.empty(vectors.shape, dtype=np.int8)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        end = start + ASSIGN_BATCH_SIZE
+        codes[start:end] = np.round(vectors[start:end] / scales[start:end, None])
+    return codes, scales.astype(np.float32)
+
+
+class IvfNamespace:
+    FILES = ('centroids', 'offsets', 'codes', 'scales', 'vectors')
+
+    def __init__(self, ids, metadata, centroids, offsets, codes, scales, vectors):
+        self.ids = ids
+        self.metadata = metadata
+        self.centroids = centroids
+        self.offsets = offsets
+        self.codes = codes
+        self.scales = scales
+        self.vectors = vectors
+        self._positions = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def positions(self):
+        if self._positions is None:
+            self._positions = {record_id: position for position, record_id in enumerate(self.ids)}
+        return self._positions
+
+    @classmethod
+    def build(cls, ids, vectors, metadata, lists_count=None, iterations=10, seed=0):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        lists_count = min(len(vectors), lists_count or max(1, int(math.sqrt(len(vectors)))))
+        centroids = train_centroids(vectors, lists_count, iterations, seed=seed)
+        assignments = assign_to_centroids(vectors, centroids)
+
+        # vectors of a list are stored next to each other
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.zeros(lists_count + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignments, minlength=lists_count))
+        vectors = vectors[order]
+        codes, scales = quantize(vectors)
+        order = order.tolist()
+        return cls([ids[position] for position in order], [metadata[position] for position in order],
+                   centroids, offsets, codes, scales, vectors)
+
+    def query(self, vector, top_k, nprobe, rerank, filter=None):
+        """Returns (positions, scores) of the best matches, best first."""
+        vector = np.asarray(vector, dtype=np.float32)
+        wanted = top_k * rerank
+
+        # closest lists first, at least `nprobe` of them and enough to fill the re-ranked candidates
+        list_order = np.argsort(-(self.centroids @ vector))
+        sizes = np.diff(self.offsets)[list_order]
+        probed = max(nprobe, int(np.searchsorted(np.cumsum(sizes), wanted)) + 1)
+        ranges = [(self.offsets[list_id], self.offsets[list_id + 1]) for list_id in list_order[:probed].tolist()]
+        positions = np.concatenate([np.arange(start, end) for start, end in ranges])
+        # list by list, the codes of a list are contiguous in the mapped file
+        approximate = np.concatenate([(self.codes[start:end] @ vector) * self.scales[start:end]
+                                      for start, end in ranges])
+        if filter:
+            allowed = np.array([matches_filter(self.metadata[position], filter) for position in positions.tolist()],
+                               dtype=bool)
+            positions, approximate = positions[allowed], approximate[allowed]
+        if not len(positions):
+            return [], []
+
+        if len(positions) > wanted:
+            positions = positions[np.argpartition(-approximate, wanted - 1)[:wanted]]
+        positions.sort()
+
+        scores = np.asarray(self.vectors[positions], dtype=np.float32) @ vector
+        best = np.argsort(-scores)[:top_k]
+        return positions[best].tolist(), scores[best].tolist()
+
+    def memory_bytes(self):
+        """Bytes scanned by the quantized search and the full-precision vectors read only to re-rank."""
+        scanned = sum(getattr(self, name).nbytes for name in ('centroids', 'offsets', 'codes', 'scales'))
+        return {'quantized': scanned, 'full_precision': self.vectors.nbytes}
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.FILES:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "records.json"), 'w') as f:
+            json.dump({'ids': self.ids, 'metadata': self.metadata}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in cls.FILES]
+        with open(os.path.join(path, "records.json")) as f:
+            records = json.load(f)
+        return cls(records['ids'], records['metadata'], *arrays)
+
+
+class AnnIndex:
+    """Read-only stand-in for a Pinecone index with the same query/fetch calls.
+
+    `nprobe` and `rerank` trade latency for recall: more probed lists and more re-ranked candidates
+    per result find more of the exact nearest neighbours.
+    """
+
+    def __init__(self, namespaces, nprobe=32, rerank=4):
+        self.namespaces = namespaces
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+    def query(self, vector, namespace="", top_k=10, include_metadata=False, filter=None):
+        target = self.namespaces.get(namespace)
+        if target is None or not len(target):
+            return {'matches': [], 'namespace': namespace}
+
+        positions, scores = target.query(vector, min(int(top_k), len(target)), self.nprobe, self.rerank, filter)
+        matches = []
+        for position, score in zip(positions, scores):
+            match = {'id': target.ids[position], 'score': score}
+            if include_metadata:
+                match['metadata'] = target.metadata[position]
+            matches.append(match)
+        return {'matches': matches, 'namespace': namespace}
+
+    def fetch(self, ids, namespace=""):
+        target = self.namespaces.get(namespace)
+        found = {}
+        for record_id in ids if target is not None else []:
+            position = target.positions.get(record_id)
+            if position is not None:
+                found[record_id] = {'id': record_id, 'values': target.vectors[position].tolist(),
+                                    'metadata': target.metadata[position]}
+        return {'vectors': found, 'namespace': namespace}
+
+    def describe_index_stats(self):
+        return {'namespaces': {name: {'vector_count': len(target)} for name, target in self.namespaces.items()}}
+
+    @classmethod
+    def build(cls, local_index, lists_count=None, **kwargs):
+        namespaces = {name: IvfNamespace.build(target.ids, target.vectors, target.metadata, lists_count)
+                      for name, target in local_index.namespaces.items() if len(target)}
+        return cls(namespaces, **kwargs)
+
+    def save(self, path):
+        for name, target in self.namespaces.items():
+            target.save(os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        namespaces = {name: IvfNamespace.load(os.path.join(path, name))
+                      for name in sorted(os.listdir(path)) if os.path.isdir(os.path.join(path, name))}
+        return cls(namespaces, **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--local-index", required=True, help="directory of the local index to build from")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--lists", type=int, help="lists per namespace, the square root of its size by default")
+    args = parser.parse_args(argv)
+
+    index = AnnIndex.build(LocalIndex.load(args.local_index), args.lists)
+    index.save(args.output)
+    for name, target in index.namespaces.items():
+        logger.info(f"{name}: {len(target)} vectors in {len(target.offsets) - 1} lists")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
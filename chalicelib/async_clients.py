@@ -0,0 +1,129 @@
+"""Asyncio clients of the outbound services and the event loop they run on.
+
+All clients share one aiohttp session per event loop. The loop lives on a daemon thread for the
+whole life of the container, so connections stay open between invocations.
+"""
+import asyncio
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import openai
+from googletrans.utils import build_params, format_json
+from telegram.error import TelegramError
+
+from chalicelib.idempotency import record_side_effect
+from chalicelib.tracing import traced
+
+HTTP_TIMEOUT_SECONDS = float(os.environ.get("HTTP_TIMEOUT_SECONDS", "30"))
+# blocking calls (boto3, the vector index) made from the event loop run on this many threads
+BLOCKING_THREADS = int(os.environ.get("BLOCKING_THREADS", "32"))
+TRANSLATE_URL = "https://translate.googleapis.com/translate_a/single"
+
+_sessions = weakref.WeakKeyDictionary()
+
+
+def http_session():
+    """The aiohttp session of the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = _sessions[loop] = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECONDS))
+    return session
+
+
+class EventLoopThread:
+    """An event loop running on a daemon thread, synchronous code submits coroutines to it."""
+
+    def __init__(self, blocking_threads=BLOCKING_THREADS):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=blocking_threads,
+                                                          thread_name_prefix="blocking"))
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        """Runs the coroutine on the loop and waits for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class Offloaded:
+    """Exposes the methods of a blocking object as coroutines run on the loop's executor.
+
+    Used for the DAOs, there is no asyncio client for DynamoDB among the dependencies.
+    """
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        method = getattr(self._target, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+        return call
+
+
+class AsyncTelegramBot:
+    """The Bot API methods the message pipeline needs, returning the raw result dicts."""
+
+    def __init__(self, token, base_url="https://api.telegram.org/bot"):
+        self.url = f"{base_url}{token}"
+
+    async def request(self, method, data):
+        async with http_session().post(f"{self.url}/{method}", json=data) as response:
+            payload = await response.json()
+        if not payload.get('ok'):
+            raise TelegramError(payload.get('description', f"{method} failed"))
+        return payload['result']
+
+    async def call(self, method, **kwargs):
+        return await self.request(method, {key: value for key, value in kwargs.items() if value is not None})
+
+    @traced("telegram.send_message")
+    async def send_message(self, chat_id, text, parse_mode=None, disable_web_page_preview=None):
+        record_side_effect()
+        return await self.call('sendMessage', chat_id=chat_id, text=text, parse_mode=parse_mode,
+                               disable_web_page_preview=disable_web_page_preview)
+
+    @traced("telegram.send_photo")
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None):
+        record_side_effect()
+        return await self.call('sendPhoto', chat_id=chat_id, photo=photo, caption=caption, parse_mode=parse_mode)
+
+    @traced("telegram.edit_message_caption")
+    async def edit_message_caption(self, chat_id, message_id, caption, parse_mode=None):
+        record_side_effect()
+        return await self.call('editMessageCaption', chat_id=chat_id, message_id=message_id, caption=caption,
+                               parse_mode=parse_mode)
+
+    @traced("telegram.send_chat_action")
+    async def send_chat_action(self, chat_id, action):
+        return await self.call('sendChatAction', chat_id=chat_id, action=action)
+
+
+@traced("translate")
+async def async_google_translate(text: str, src: str, target: str):
+    # the same request googletrans makes with its default "gtx" client
+    params = build_params(client='gtx', query=text, src=src, dest=target, token='xxxx', override=None)
+    query = [(key, str(item)) for key, value in params.items()
+             for item in (value if isinstance(value, list) else [value])]
+    async with http_session().get(TRANSLATE_URL, params=query) as response:
+        response.raise_for_status()
+        data = format_json(await response.text())
+    return ''.join(part[0] for part in data[0] if part[0])
+
+
+@traced("embed")
+async def async_generate_embedding(_text: str):
+    openai.aiosession.set(http_session())
+    response = await openai.Embedding.acreate(model="text-embedding-ada-002", input=_text)
+    return response["data"][0]["embedding"], response["usage"]["total_tokens"]
@@ -0,0 +1,83 @@
+"""Batch search over many questions.
+
+Run from the repository root:
+
+    python -m chalicelib.batch_search evaluate questions.json --top-k 3
+    python -m chalicelib.batch_search prewarm popular_questions.json
+
+`evaluate` expects {"responses": [{"query": "...", "expected": ["<video_id>", ...]}, ...]} and reports
+how often and how high the expected satsangs are ranked. `prewarm` expects {"responses": ["...", ...]}
+and stores the results in the precomputed results cache used by `search`.
+"""
+import argparse
+import json
+import sys
+import time
+
+from loguru import logger
+
+from chalicelib.search import batch_search, compact_result, normalize_query, load_cached_results, \
+    record_video_id, SEARCH_RESULTS_CACHE_PATH
+from chalicelib.utils import get_list
+
+
+def video_id_of(result):
+    return record_video_id(result['id'])
+
+
+def evaluate(cases, results, top_k):
+    hits = 0
+    reciprocal_ranks = 0.0
+    for case, case_results in zip(cases, results):
+        expected = set(case['expected'])
+        ranked_video_ids = [video_id_of(result) for result in case_results[:top_k]]
+        for rank, video_id in enumerate(ranked_video_ids, start=1):
+            if video_id in expected:
+                hits += 1
+                reciprocal_ranks += 1 / rank
+                break
+
+    return {
+        'queries': len(cases),
+        f'hit@{top_k}': hits / len(cases) if cases else 0.0,
+        'mrr': reciprocal_ranks / len(cases) if cases else 0.0,
+    }
+
+
+def prewarm(queries, results, output_path):
+    cache = load_cached_results(output_path)
+    for query, query_results in zip(queries, results):
+        cache[normalize_query(query)] = [compact_result(result) for result in query_results]
+
+    with open(output_path, 'w') as f:
+        json.dump({'responses': cache}, f, ensure_ascii=False, indent=2)
+    return len(cache)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["evaluate", "prewarm"])
+    parser.add_argument("input")
+    parser.add_argument("--output", default=SEARCH_RESULTS_CACHE_PATH, help="results cache written by prewarm")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=100, help="queries per embedding call")
+    parser.add_argument("--max-workers", type=int, default=8, help="index queries running in parallel")
+    args = parser.parse_args(argv)
+
+    items = get_list(args.input)
+    queries = [item['query'] for item in items] if args.command == "evaluate" else items
+
+    start = time.perf_counter()
+    results = batch_search(queries, top_k=args.top_k, batch_size=args.batch_size, max_workers=args.max_workers)
+    logger.info(f"Searched {len(queries)} queries in {time.perf_counter() - start:.1f} seconds")
+
+    if args.command == "evaluate":
+        print(json.dumps(evaluate(items, results, args.top_k), indent=2))
+    else:
+        cached_count = prewarm(queries, results, args.output)
+        print(f"{cached_count} queries are cached in {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+class RequestTicket:
+    def __init__(self, in_flight_requests, user_id, update_id):
+        self.in_flight_requests = in_flight_requests
+        self.user_id = user_id
+        self.update_id = update_id
+
+    def is_superseded(self):
+        return self.in_flight_requests.latest(self.user_id) not in (None, self.update_id)
+
+
+class InFlightRequests:
+    """Tracks the latest search request of every user in this container.
+
+    Updates are announced as soon as they arrive, so a request can find out that the same user has
+    sent a newer question while it was waiting or running and give up before the expensive stages.
+    """
+
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+
+    def announce(self, user_id, update_id):
+        with self._lock:
+            current = self._latest.get(user_id)
+            if current is not None and update_id <= current:
+                return
+            self._latest[user_id] = update_id
+            self._latest.move_to_end(user_id)
+            if len(self._latest) > self.max_users:
+                self._latest.popitem(last=False)
+
+    def latest(self, user_id):
+        with self._lock:
+            return self._latest.get(user_id)
+
+    def ticket(self, user_id, update_id):
+        self.announce(user_id, update_id)
+        return RequestTicket(self, user_id, update_id)
+
+    def finish(self, ticket):
+        with self._lock:
+            if self._latest.get(ticket.user_id) == ticket.update_id:
+                del self._latest[ticket.user_id]
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs a function once for all concurrent callers with the same key."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Calls func(call) or waits for the call already in flight for the key.
+
+        The leading call can check `call.waiters` to know whether other callers depend on it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(call)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop, `func` is a coroutine function.
+
+    The call runs as a task of its own, so cancelling the caller that started it leaves it running
+    for the others; `func` is expected to stop at its own checks once nobody waits for it.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = Call()
+            call.result = asyncio.ensure_future(func(call))
+            call.result.add_done_callback(lambda task: self._finish(key, task))
+        else:
+            call.waiters += 1
+        # a cancelled caller must not cancel the call of the others
+        return await asyncio.shield(call.result)
+
+    def _finish(self, key, task):
+        del self._calls[key]
+        if not task.cancelled():
+            # retrieved here, so that a call nobody waits for any more is not reported as unhandled
+            task.exception()
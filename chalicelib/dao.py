@@ -1,3 +1,4 @@
+import time
 from datetime import date, timedelta, datetime
 
 import boto3
@@ -5,12 +6,15 @@ from botocore.exceptions import ClientError
 from dateutil.parser import parse
 from loguru import logger
 
+from chalicelib.tracing import traced
+
 
 class UserAnalyticsDao:
     def __init__(self):
         self.dynamodb = boto3.resource('dynamodb')
         self.table = self.dynamodb.Table("user_analytics")
 
+    @traced("dynamodb.get_all_active_users")
     def get_all_active_users(self, days):
         now = datetime.now()
         cutoff = now - timedelta(days=days)
@@ -25,6 +29,7 @@ class UserAnalyticsDao:
         except ClientError as e:
             logger.error(e)
 
+    @traced("dynamodb.get_active_users_count")
     def get_active_users_count(self, days=30):
         now = datetime.now()
         cutoff = now - timedelta(days=days)
@@ -39,10 +44,12 @@ class UserAnalyticsDao:
 
         return active_users_count
 
+    @traced("dynamodb.get_total_users_count")
     def get_total_users_count(self):
         response = self.table.scan()  # todo: slow
         return len(response['Items'])
 
+    @traced("dynamodb.user_exists")
     def user_exists(self, user_id):
         try:
             response = self.table.get_item(
@@ -55,6 +62,7 @@ class UserAnalyticsDao:
         else:
             return 'Item' in response
 
+    @traced("dynamodb.register_user")
     def register_user(self, user_id):
         now = datetime.now()
         try:
@@ -68,6 +76,7 @@ class UserAnalyticsDao:
         except ClientError as e:
             logger.info(e)
 
+    @traced("dynamodb.update_last_seen")
     def update_last_seen(self, user_id):
         try:
             self.table.update_item(
@@ -90,6 +99,7 @@ class UserRequestsDao:
         self.dynamodb = boto3.resource('dynamodb')
         self.table = self.dynamodb.Table(self.table_name)
 
+    @traced("dynamodb.reset_user_requests_count")
     def reset_user_requests_count(self, user_id):
         try:
             current_date = date.today()
@@ -105,6 +115,7 @@ class UserRequestsDao:
         except ClientError as e:
             logger.error(f"Error resetting user requests count: {e}")
 
+    @traced("dynamodb.get_user_requests_count")
     def get_user_requests_count(self, user_id):
         try:
             current_date = date.today()
@@ -130,6 +141,7 @@ class UserRequestsDao:
             logger.info(f"Error retrieving user requests count: {e}")
             return 0
 
+    @traced("dynamodb.update_user_requests_count")
     def update_user_requests_count(self, user_id):
         try:
             current_date = date.today()
@@ -148,3 +160,79 @@ class UserRequestsDao:
         except ClientError as e:
             logger.info(f"Error updating user requests count: {e}")
             return None
+
+
+class ProcessedUpdatesDao:
+    def __init__(self):
+        self.table_name = "processed_updates"
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table = self.dynamodb.Table(self.table_name)
+
+    @traced("dynamodb.claim_update")
+    def claim(self, update_id, lease_seconds, owner=None):
+        """Marks the update as in progress for `lease_seconds`.
+
+        Returns False if it is processed or in progress elsewhere. An expired lease, left by a
+        container that crashed, can be claimed again, and so can an unexpired one of the same
+        `owner`: there is one polling worker at a time, the leases it finds are of a crashed one.
+        """
+        now = int(time.time())
+        item = {
+            'update_id': str(update_id),
+            'expires_at': now + lease_seconds
+        }
+        condition = 'attribute_not_exists(update_id) OR expires_at < :now'
+        values = {':now': now}
+        if owner is not None:
+            item['lease_owner'] = owner
+            condition += ' OR lease_owner = :owner'
+            values[':owner'] = owner
+        try:
+            self.table.put_item(
+                Item=item,
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            logger.error(f"Error claiming update {update_id}: {e}")
+        return True
+
+    @traced("dynamodb.mark_update_processed")
+    def mark_processed(self, update_id, ttl_seconds):
+        """Keeps the marker of a processed update, expired markers are removed by DynamoDB TTL."""
+        try:
+            self.table.update_item(
+                Key={'update_id': str(update_id)},
+                UpdateExpression='SET expires_at = :expires_at REMOVE lease_owner',
+                ExpressionAttributeValues={':expires_at': int(time.time()) + ttl_seconds}
+            )
+        except ClientError as e:
+            logger.error(f"Error marking update {update_id} as processed: {e}")
+
+    @traced("dynamodb.release_update")
+    def release(self, update_id):
+        """Removes the marker of a failed update, so that its re-delivery is processed."""
+        try:
+            self.table.delete_item(Key={'update_id': str(update_id)})
+        except ClientError as e:
+            logger.error(f"Error releasing update {update_id}: {e}")
+
+
+class ServiceStateDao:
+    def __init__(self):
+        self.table_name = "service_state"
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table = self.dynamodb.Table(self.table_name)
+
+    @traced("dynamodb.is_available")
+    def is_available(self, service):
+        """Returns None if the state of the service has never been set."""
+        try:
+            response = self.table.get_item(Key={'service': service})
+        except ClientError as e:
+            logger.error(f"Error retrieving state of {service}: {e}")
+            return None
+        item = response.get('Item')
+        return bool(item.get('available', True)) if item else None
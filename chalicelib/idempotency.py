@@ -0,0 +1,93 @@
+import contextvars
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from loguru import logger
+
+_side_effects = contextvars.ContextVar("side_effects", default=None)
+
+
+@contextmanager
+def tracking_side_effects():
+    """Yields an event that is set once the update being processed sends something to the user.
+
+    A failed update whose replies have started is not released, its re-delivery would repeat them.
+    Stages on other threads and tasks share the event through the copied context.
+    """
+    started = threading.Event()
+    token = _side_effects.set(started)
+    try:
+        yield started
+    finally:
+        _side_effects.reset(token)
+
+
+def record_side_effect():
+    started = _side_effects.get()
+    if started is not None:
+        started.set()
+
+
+class RecentIds:
+    """Bounded set of the most recently seen ids."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, item_id):
+        """Returns False if the id is already in the set."""
+        with self._lock:
+            if item_id in self._ids:
+                self._ids.move_to_end(item_id)
+                return False
+            self._ids[item_id] = True
+            if len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, item_id):
+        with self._lock:
+            self._ids.pop(item_id, None)
+
+
+class UpdateDeduplicator:
+    """Lets every Telegram update through once.
+
+    Re-deliveries to the same container are caught by the recent ids, re-deliveries to other
+    containers by the conditional put of the processed updates DAO. An update is claimed for
+    `lease_seconds` and marked processed for `ttl_seconds` once its handlers succeed; a failed update
+    is released, so that the re-delivery by Telegram or SQS is processed again. The leases of an
+    `owner` are reclaimed by the next process of that owner, the polling worker replays the updates
+    its crashed predecessor left in progress.
+    """
+
+    def __init__(self, processed_updates_dao, ttl_seconds=86400, recent_ids_size=1024, lease_seconds=300,
+                 owner=None):
+        self.processed_updates_dao = processed_updates_dao
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.owner = owner
+        self.recent_ids = RecentIds(recent_ids_size)
+
+    def claim(self, update_id):
+        if update_id is None:
+            return True
+        if not self.recent_ids.add(update_id):
+            logger.info(f"Update {update_id} has been received by this container already")
+            return False
+        if not self.processed_updates_dao.claim(update_id, self.lease_seconds, self.owner):
+            logger.info(f"Update {update_id} has been processed already or is in progress")
+            return False
+        return True
+
+    def complete(self, update_id):
+        if update_id is not None:
+            self.processed_updates_dao.mark_processed(update_id, self.ttl_seconds)
+
+    def release(self, update_id):
+        if update_id is not None:
+            self.recent_ids.discard(update_id)
+            self.processed_updates_dao.release(update_id)
@@ -0,0 +1,243 @@
+"""Incremental ingestion of satsang transcripts into the "text" and "meaning" namespaces.
+
+Run from the repository root:
+
+    python -m chalicelib.ingestion --transcripts-dir transcripts
+    python -m chalicelib.ingestion --transcripts-dir transcripts --local-index .local_index
+
+Only videos of chalicelib/cache/youtube_links.json that are neither in the checkpoint nor already
+in the index are processed. Transcripts are read from `<transcripts-dir>/<video_id>.json` as a list
+of {"text", "start", "duration"} segments, the format of youtube-transcript-api.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from loguru import logger
+
+from chalicelib.utils import get_list, extract_video_id, chunked, generate_embeddings, google_translate_batch
+
+VIDEO_LINKS_PATH = "chalicelib/cache/youtube_links.json"
+VIDEO_TITLES_PATH = "chalicelib/cache/youtube_titles.csv"
+CHECKPOINT_PATH = ".ingestion_checkpoint.json"
+
+
+def meaning_record_id(video_id, start):
+    return f"{video_id}-t{int(start)}"
+
+
+def text_record_id(video_id, start):
+    return f"{video_id}-t{int(start)}-c"
+
+
+def load_video_listing(links_path=VIDEO_LINKS_PATH, titles_path=VIDEO_TITLES_PATH):
+    videos = {video_id: {'video_id': video_id, 'title': '', 'subtitle': '', 'published': ''}
+              for video_id in get_list(links_path)}
+    with open(titles_path, 'r') as csv_file:
+        for row in csv.DictReader(csv_file):
+            video_id = extract_video_id(row['Ссылка на видео в YouTube'])
+            if video_id:
+                videos[video_id] = {
+                    'video_id': video_id,
+                    'title': row['Заголовок'],
+                    'subtitle': row['Подзаголовок'],
+                    'published': row['Дата выпуска'],
+                }
+    return list(videos.values())
+
+
+def load_transcript(video_id, transcripts_dir):
+    with open(os.path.join(transcripts_dir, f"{video_id}.json")) as f:
+        return json.load(f)
+
+
+def chunk_transcript(video, segments, text_chunk_seconds=60, meaning_chunk_seconds=300):
+    """Split transcript segments into text chunks, grouped into larger meaning segments.
+
+    The first meaning segment always starts at 0, so `meaning_record_id(video_id, 0)` marks an
+    ingested video.
+    """
+    video_id = video['video_id']
+    text_chunks = []
+    current = None
+    for segment in segments:
+        if current is None:
+            current = {'start': 0 if not text_chunks else segment['start'], 'texts': []}
+        current['texts'].append(segment['text'].strip())
+        current['end'] = segment['start'] + segment.get('duration', 0)
+        if current['end'] - current['start'] >= text_chunk_seconds:
+            text_chunks.append(current)
+            current = None
+    if current is not None:
+        text_chunks.append(current)
+
+    meanings = []
+    for chunk in text_chunks:
+        if not meanings or chunk['start'] - meanings[-1]['start'] >= meaning_chunk_seconds:
+            meanings.append({'id': meaning_record_id(video_id, chunk['start']), 'start': chunk['start'], 'texts': []})
+        meaning = meanings[-1]
+        text = " ".join(text for text in chunk['texts'] if text)
+        meaning['texts'].append({
+            'id': text_record_id(video_id, chunk['start']),
+            'text': text,
+            'metadata': {
+                'meaning_id': meaning['id'],
+                'text': text,
+                'title': video['title'],
+                'url': f"https://www.youtube.com/watch?v={video_id}",
+                'start': float(chunk['start']),
+                'published': video['published'],
+                'video_id': video_id,
+            },
+        })
+
+    texts = [text for meaning in meanings for text in meaning['texts']]
+    meaning_records = [{
+        'id': meaning['id'],
+        'text': " ".join(text['text'] for text in meaning['texts']),
+        'metadata': {'video_id': video_id, 'start': float(meaning['start'])},
+    } for meaning in meanings]
+    return texts, meaning_records
+
+
+class Checkpoint:
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.completed = set(json.load(f)['completed'])
+        except FileNotFoundError:
+            self.completed = set()
+
+    def mark_completed(self, video_id):
+        with self._lock:
+            self.completed.add(video_id)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'completed': sorted(self.completed)}, f)
+            os.replace(tmp_path, self.path)
+
+
+class Ingestion:
+    def __init__(self, index, checkpoint, transcripts_dir, embedding_batch_size=100, upsert_batch_size=100,
+                 max_concurrent_embeddings=4, translate=True, embed=generate_embeddings,
+                 translate_batch=google_translate_batch):
+        self.index = index
+        self.checkpoint = checkpoint
+        self.transcripts_dir = transcripts_dir
+        self.embedding_batch_size = embedding_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.translate = translate
+        self.embed = embed
+        self.translate_batch = translate_batch
+        self.embedding_slots = threading.BoundedSemaphore(max_concurrent_embeddings)
+
+    def indexed_video_ids(self, video_ids):
+        indexed = set()
+        for batch in chunked(list(video_ids), 100):
+            markers = {meaning_record_id(video_id, 0): video_id for video_id in batch}
+            response = self.index.fetch(ids=list(markers), namespace="meaning")
+            indexed.update(markers[record_id] for record_id in response['vectors'])
+        return indexed
+
+    def pending_videos(self, videos):
+        candidates = [video for video in videos if video['video_id'] not in self.checkpoint.completed]
+        indexed = self.indexed_video_ids(video['video_id'] for video in candidates)
+        for video_id in indexed:
+            self.checkpoint.mark_completed(video_id)
+        return [video for video in candidates
+                if video['video_id'] not in indexed
+                and os.path.exists(os.path.join(self.transcripts_dir, f"{video['video_id']}.json"))]
+
+    def embed_records(self, records):
+        vectors = []
+        for batch in chunked(records, self.embedding_batch_size):
+            texts = [record['text'] for record in batch]
+            if self.translate:
+                texts = self.translate_batch(texts, "ru", "en")
+            with self.embedding_slots:
+                embeddings, _ = self.embed(texts)
+            vectors.extend({'id': record['id'], 'values': embedding, 'metadata': record['metadata']}
+                           for record, embedding in zip(batch, embeddings))
+        return vectors
+
+    def upsert(self, vectors, namespace):
+        for batch in chunked(vectors, self.upsert_batch_size):
+            self.index.upsert(vectors=batch, namespace=namespace)
+
+    def ingest_video(self, video):
+        segments = load_transcript(video['video_id'], self.transcripts_dir)
+        texts, meanings = chunk_transcript(video, segments)
+        if not any(text['text'] for text in texts):
+            # nothing to search in, the marker alone is embedded from the title so that the video
+            # is not read again on every run
+            marker = {'id': meaning_record_id(video['video_id'], 0), 'text': video['title'],
+                      'metadata': {'video_id': video['video_id'], 'start': 0.0}}
+            self.upsert(self.embed_records([marker]), "meaning")
+            self.checkpoint.mark_completed(video['video_id'])
+            return 0, 0
+        self.upsert(self.embed_records(texts), "text")
+        # the meaning that starts at 0 goes last, its presence marks the whole video as ingested
+        self.upsert(self.embed_records(meanings[1:] + meanings[:1]), "meaning")
+        self.checkpoint.mark_completed(video['video_id'])
+        return len(texts), len(meanings)
+
+    def run(self, videos, max_workers=4):
+        pending = self.pending_videos(videos)
+        logger.info(f"{len(pending)} of {len(videos)} videos need to be ingested")
+
+        ingested = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.ingest_video, video): video['video_id'] for video in pending}
+            for future in as_completed(futures):
+                video_id = futures[future]
+                try:
+                    texts_count, meanings_count = future.result()
+                except Exception as e:
+                    logger.error(f"Ingestion of {video_id} failed, it will be retried on the next run: {e}")
+                else:
+                    ingested += 1
+                    logger.info(f"Ingested {video_id}: {texts_count} texts, {meanings_count} meanings")
+        return ingested
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transcripts-dir", required=True)
+    parser.add_argument("--local-index", help="directory of a local index to use instead of Pinecone")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--max-workers", type=int, default=4, help="videos processed in parallel")
+    parser.add_argument("--max-concurrent-embeddings", type=int, default=4)
+    parser.add_argument("--embedding-batch-size", type=int, default=100)
+    parser.add_argument("--upsert-batch-size", type=int, default=100)
+    parser.add_argument("--no-translate", action="store_true", help="embed the Russian text as is")
+    args = parser.parse_args(argv)
+
+    if args.local_index:
+        from chalicelib.local_index import LocalIndex
+        index = LocalIndex.load(args.local_index)
+    else:
+        from chalicelib.search import TextSearch
+        index = TextSearch.load_index()
+
+    ingestion = Ingestion(index, Checkpoint(args.checkpoint), args.transcripts_dir,
+                          embedding_batch_size=args.embedding_batch_size,
+                          upsert_batch_size=args.upsert_batch_size,
+                          max_concurrent_embeddings=args.max_concurrent_embeddings,
+                          translate=not args.no_translate)
+    try:
+        ingested = ingestion.run(load_video_listing(), max_workers=args.max_workers)
+    finally:
+        if args.local_index:
+            index.save(args.local_index)
+    print(f"{ingested} videos ingested")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""BM25 inverted index over the Russian text chunks and satsang titles.
+
+Built offline from the same transcripts as the vector index, run from the repository root:
+
+    python -m chalicelib.lexical_index --transcripts-dir transcripts
+
+The index is a directory of numpy arrays that are memory-mapped at runtime: the postings of term
+`i` are `postings[offsets[i]:offsets[i + 1]]` with the matching term frequencies in `frequencies`.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from collections import Counter
+
+import numpy as np
+from loguru import logger
+
+from chalicelib.tracing import traced
+
+LEXICAL_INDEX_PATH = "chalicelib/cache/lexical_index"
+# a title term counts as this many occurrences in every chunk of the satsang
+TITLE_WEIGHT = 2
+
+WORD_RE = re.compile(r"[а-яёa-z0-9]+")
+STOPWORDS = frozenset("""
+    а без бы был была были было быть в вам вас весь во вот все всего вы где да даже для до его ее если
+    есть еще же за и из или им их к как ко когда кто ли либо мне мной мы на над надо не него нее нет ни
+    них но ну о об однако он она они оно от по под при про с со так также такой там те тем то того тоже
+    той только том ты у уже чем что чтобы эта эти это этот я
+""".split())
+
+_RV_RE = re.compile(r"^(.*?[аеиоуыэюя])(.*)$")
+_PERFECTIVE_GERUND_RE = re.compile(r"((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$")
+_REFLEXIVE_RE = re.compile(r"(с[яь])$")
+_ADJECTIVE_RE = re.compile(r"(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$")
+_PARTICIPLE_RE = re.compile(r"((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$")
+_VERB_RE = re.compile(r"((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|"
+                      r"ить|ыть|ишь|ую|ю)|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$")
+_NOUN_RE = re.compile(r"(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|"
+                      r"ию|ью|ю|ия|ья|я)$")
+_DERIVATIONAL_RE = re.compile(r".*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$")
+
+
+def stem(word):
+    """Porter stemmer for Russian, words of other alphabets are returned as is."""
+    match = _RV_RE.match(word)
+    if not match:
+        return word
+    prefix, rv = match.groups()
+
+    stripped = _PERFECTIVE_GERUND_RE.sub("", rv, 1)
+    if stripped != rv:
+        rv = stripped
+    else:
+        rv = _REFLEXIVE_RE.sub("", rv, 1)
+        stripped = _ADJECTIVE_RE.sub("", rv, 1)
+        if stripped != rv:
+            rv = _PARTICIPLE_RE.sub("", stripped, 1)
+        else:
+            stripped = _VERB_RE.sub("", rv, 1)
+            rv = stripped if stripped != rv else _NOUN_RE.sub("", rv, 1)
+
+    rv = re.sub(r"и$", "", rv)
+    if _DERIVATIONAL_RE.match(rv):
+        rv = re.sub(r"ость?$", "", rv)
+    if rv.endswith("ь"):
+        rv = rv[:-1]
+    else:
+        rv = re.sub(r"(ейше|ейш)$", "", rv)
+        rv = re.sub(r"нн$", "н", rv)
+    return prefix + rv
+
+
+def analyze(text):
+    """Splits the text into stemmed terms without stopwords."""
+    words = WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [stem(word) for word in words if word not in STOPWORDS]
+
+
+class LexicalIndex:
+    """Okapi BM25 over text chunks, `search` returns Pinecone-like matches.
+
+    The `score` of a match is its BM25 score relative to a chunk that contains every query term once
+    and has the average length, clipped to 1, so that it can be compared across queries. Its
+    `coverage` is the IDF-weighted share of the query terms the chunk contains.
+    """
+
+    def __init__(self, terms, offsets, postings, frequencies, doc_lengths, doc_ids, metadata, k1=1.2, b=0.75):
+        self.term_ids = {term: position for position, term in enumerate(terms)}
+        self.offsets = offsets
+        self.postings = postings
+        self.frequencies = frequencies
+        self.doc_ids = doc_ids
+        self.metadata = metadata
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+
+        docs_count = len(doc_ids)
+        document_frequencies = np.diff(offsets).astype(np.float32)
+        self.idf = np.log1p((docs_count - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        self.missing_idf = float(np.log1p((docs_count + 0.5) / 0.5))
+        average_length = float(doc_lengths.mean()) if docs_count else 1.0
+        self.length_norm = (k1 * (1 - b + b * doc_lengths / average_length)).astype(np.float32)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @traced("index.lexical_query")
+    def search(self, query, top_k=10):
+        terms = set(analyze(query))
+        if not terms or not len(self):
+            return []
+
+        scores = np.zeros(len(self), dtype=np.float32)
+        matched_idf = np.zeros(len(self), dtype=np.float32)
+        ideal_score = 0.0
+        for term in terms:
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                ideal_score += self.missing_idf
+                continue
+            ideal_score += float(self.idf[term_id])
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.postings[start:end]
+            frequencies = self.frequencies[start:end]
+            scores[docs] += self.idf[term_id] * frequencies * (self.k1 + 1) / (frequencies + self.length_norm[docs])
+            matched_idf[docs] += self.idf[term_id]
+
+        top_k = min(int(top_k), len(self))
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        ordered = candidates[np.argsort(-scores[candidates])]
+        ordered = ordered[scores[ordered] > 0]
+
+        return [{'id': self.doc_ids[position], 'score': min(score / ideal_score, 1.0), 'bm25': score,
+                 'coverage': matched / ideal_score, 'metadata': self.metadata[position]}
+                for position, score, matched in zip(ordered.tolist(), scores[ordered].tolist(),
+                                                    matched_idf[ordered].tolist())]
+
+    @classmethod
+    def build(cls, records, **kwargs):
+        """Builds the index from text records with the Russian `text` and the Pinecone metadata.
+
+        The chunk text itself is left out of the stored metadata to keep the index small.
+        """
+        postings = {}
+        doc_ids, metadata, doc_lengths = [], [], []
+        for position, record in enumerate(records):
+            counts = Counter(analyze(record['text']))
+            for term in analyze(record.get('title', '')):
+                counts[term] += TITLE_WEIGHT
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((position, count))
+            doc_ids.append(record['id'])
+            metadata.append({key: value for key, value in record['metadata'].items() if key != 'text'})
+            doc_lengths.append(sum(counts.values()))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        flat = [posting for term in terms for posting in postings[term]]
+        return cls(terms, offsets,
+                   np.array([doc for doc, _ in flat], dtype=np.int32),
+                   np.array([count for _, count in flat], dtype=np.float32),
+                   np.array(doc_lengths, dtype=np.float32), doc_ids, metadata, **kwargs)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ('offsets', 'postings', 'frequencies', 'doc_lengths'):
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        terms = sorted(self.term_ids, key=self.term_ids.get)
+        with open(os.path.join(path, "terms.json"), 'w') as f:
+            json.dump(terms, f, ensure_ascii=False)
+        with open(os.path.join(path, "docs.json"), 'w') as f:
+            json.dump({'ids': self.doc_ids, 'metadata': self.metadata}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Loads the index from a directory, or returns None if there is none."""
+        if not os.path.isdir(path):
+            return None
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+                  for name in ('offsets', 'postings', 'frequencies', 'doc_lengths')}
+        with open(os.path.join(path, "terms.json")) as f:
+            terms = json.load(f)
+        with open(os.path.join(path, "docs.json")) as f:
+            docs = json.load(f)
+        return cls(terms, arrays['offsets'], arrays['postings'], arrays['frequencies'], arrays['doc_lengths'],
+                   docs['ids'], docs['metadata'], **kwargs)
+
+
+def main(argv=None):
+    from chalicelib.ingestion import load_video_listing, load_transcript, chunk_transcript
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transcripts-dir", required=True)
+    parser.add_argument("--output", default=LEXICAL_INDEX_PATH)
+    args = parser.parse_args(argv)
+
+    records = []
+    for video in load_video_listing():
+        try:
+            segments = load_transcript(video['video_id'], args.transcripts_dir)
+        except FileNotFoundError:
+            continue
+        texts, _ = chunk_transcript(video, segments)
+        title = f"{video['title']} {video['subtitle']}"
+        records.extend({'id': text['id'], 'text': text['text'], 'title': title, 'metadata': text['metadata']}
+                       for text in texts)
+
+    index = LexicalIndex.build(records)
+    index.save(args.output)
+    logger.info(f"Lexical index of {len(index)} chunks and {len(index.term_ids)} terms written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
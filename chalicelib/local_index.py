@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class LocalNamespace:
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+        self.metadata = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._pending = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def vectors(self):
+        if self._pending:
+            pending = np.array(self._pending, dtype=np.float32)
+            self._vectors = pending if not len(self._vectors) else np.vstack([self._vectors, pending])
+            self._pending = []
+        return self._vectors
+
+    def upsert(self, record_id, values, metadata):
+        position = self.positions.get(record_id)
+        if position is None:
+            self.positions[record_id] = len(self.ids)
+            self.ids.append(record_id)
+            self.metadata.append(metadata or {})
+            self._pending.append(values)
+        else:
+            self.vectors[position] = values
+            self.metadata[position] = metadata or {}
+
+
+def matches_filter(metadata, filter_query):
+    for field, condition in filter_query.items():
+        value = metadata.get(field)
+        for operator, expected in condition.items():
+            if operator == "$eq" and value != expected:
+                return False
+            if operator == "$in" and value not in expected:
+                return False
+    return True
+
+
+class LocalIndex:
+    """In-process stand-in for a Pinecone index with the same upsert/fetch/query calls.
+
+    Queries are exact dot-product scans, which equal cosine similarity for the normalized OpenAI
+    embeddings. The index can be saved to and loaded from a directory.
+    """
+
+    def __init__(self):
+        self.namespaces = {}
+        self._lock = threading.Lock()
+
+    def _namespace(self, namespace):
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = LocalNamespace()
+        return self.namespaces[namespace]
+
+    def upsert(self, vectors, namespace=""):
+        with self._lock:
+            target = self._namespace(namespace)
+            for vector in vectors:
+                if isinstance(vector, dict):
+                    target.upsert(vector['id'], vector['values'], vector.get('metadata'))
+                else:
+                    target.upsert(*vector)
+        return {'upserted_count': len(vectors)}
+
+    def fetch(self, ids, namespace=""):
+        with self._lock:
+            target = self._namespace(namespace)
+            vectors = target.vectors
+            found = {}
+            for record_id in ids:
+                position = target.positions.get(record_id)
+                if position is not None:
+                    found[record_id] = {'id': record_id, 'values': vectors[position].tolist(),
+                                        'metadata': target.metadata[position]}
+        return {'vectors': found, 'namespace': namespace}
+
+    def describe_index_stats(self):
+        with self._lock:
+            return {'namespaces': {name: {'vector_count': len(target)} for name, target in self.namespaces.items()}}
+
+    def query(self, vector, namespace="", top_k=10, include_metadata=False, filter=None):
+        with self._lock:
+            target = self._namespace(namespace)
+            vectors = target.vectors
+            ids, metadata = target.ids, target.metadata
+        if not ids:
+            return {'matches': [], 'namespace': namespace}
+
+        scores = vectors @ np.asarray(vector, dtype=np.float32)
+        if filter:
+            allowed = np.array([matches_filter(item, filter) for item in metadata])
+            scores = np.where(allowed, scores, -np.inf)
+
+        top_k = min(int(top_k), len(ids))
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        ordered = candidates[np.argsort(-scores[candidates])]
+        if filter:
+            ordered = ordered[np.isfinite(scores[ordered])]
+
+        matches = []
+        for position, score in zip(ordered.tolist(), scores[ordered].tolist()):
+            match = {'id': ids[position], 'score': score}
+            if include_metadata:
+                match['metadata'] = metadata[position]
+            matches.append(match)
+        return {'matches': matches, 'namespace': namespace}
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            for name, target in self.namespaces.items():
+                np.save(os.path.join(path, f"{name}.npy"), target.vectors)
+                with open(os.path.join(path, f"{name}.json"), 'w') as f:
+                    json.dump({'ids': target.ids, 'metadata': target.metadata}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        if not os.path.isdir(path):
+            return index
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith(".json"):
+                continue
+            name = file_name[:-len(".json")]
+            with open(os.path.join(path, file_name)) as f:
+                content = json.load(f)
+            target = index._namespace(name)
+            target.ids = content['ids']
+            target.metadata = content['metadata']
+            target.positions = {record_id: position for position, record_id in enumerate(target.ids)}
+            target._vectors = np.load(os.path.join(path, f"{name}.npy"))
+        return index
@@ -0,0 +1,220 @@
+"""Long-polling run mode for self-hosted and container deployments.
+
+Updates fetched with getUpdates are dispatched to a bounded pool that runs the chats in parallel
+and the updates of a chat in order, while the next updates are being fetched. Telegram considers
+an update confirmed once getUpdates is called with a higher offset. Each poll passes the update
+after the last one fetched, so a slow update never holds back the others, and confirms everything
+fetched before. The updates in progress are confirmed as well, so they are saved to a file before
+the poll that confirms them and dispatched again when the worker starts after a crash; their
+leases are reclaimed by the deduplicator of the next worker. On a clean stop the worker waits for
+the updates in progress and commits the checkpoint.
+"""
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from chalicelib.update_queue import chat_id_of, is_valid_update
+
+
+class PendingUpdates:
+    """The updates in progress kept in a JSON file, written on every change."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.updates = {update_json['update_id']: update_json for update_json in json.load(f)['updates']}
+        except FileNotFoundError:
+            self.updates = {}
+
+    def add(self, updates):
+        with self._lock:
+            for update_json in updates:
+                self.updates[update_json['update_id']] = update_json
+            self._save()
+
+    def discard(self, update_id):
+        with self._lock:
+            if self.updates.pop(update_id, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'updates': [self.updates[update_id] for update_id in sorted(self.updates)]}, f)
+        os.replace(tmp_path, self.path)
+
+
+class ChatDispatcher:
+    """Runs updates on `max_workers` threads, one update of a chat at a time in arrival order."""
+
+    def __init__(self, process_update, max_workers=4, on_done=None):
+        self.process_update = process_update
+        self.on_done = on_done
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat")
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def dispatch(self, update_json):
+        chat_id = str(chat_id_of(update_json))
+        with self._lock:
+            chat_updates = self._chats.get(chat_id)
+            if chat_updates is not None:
+                # the thread of the chat picks it up after the updates before it
+                chat_updates.append(update_json)
+                return
+            self._chats[chat_id] = deque([update_json])
+        self.executor.submit(self.run_chat, chat_id)
+
+    def run_chat(self, chat_id):
+        while True:
+            with self._lock:
+                chat_updates = self._chats[chat_id]
+                if not chat_updates:
+                    del self._chats[chat_id]
+                    return
+                update_json = chat_updates.popleft()
+            try:
+                self.process_update(update_json)
+            except Exception as e:
+                logger.error(f"Processing of update {update_json.get('update_id')} failed: {e}")
+            finally:
+                if self.on_done is not None:
+                    self.on_done(update_json)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class LongPollingWorker:
+    """Fetches updates with getUpdates and keeps at most `max_pending` of them in progress.
+
+    The pool runs `max_workers` updates at once, the others wait in memory until their chat's turn.
+    The updates in progress are saved to `pending_path` if it is set. A stop is noticed between
+    polls, `poll_timeout` bounds how long it takes.
+    """
+
+    def __init__(self, bot, process_update, announce_update=None, max_workers=4, limit=100, poll_timeout=5,
+                 max_pending=None, retry_seconds=5, pending_path=None):
+        self.bot = bot
+        self.announce_update = announce_update
+        self.limit = limit
+        self.poll_timeout = poll_timeout
+        self.max_pending = max_pending or limit
+        self.retry_seconds = retry_seconds
+        self.dispatcher = ChatDispatcher(process_update, max_workers, on_done=self.finish)
+        self.pending = PendingUpdates(pending_path) if pending_path else None
+        self.unfinished = set()
+        self.last_seen = None
+        self.stopping = threading.Event()
+        self._changed = threading.Condition()
+
+    @property
+    def offset(self):
+        """The offset of the next poll, it confirms every update fetched so far."""
+        return self.last_seen + 1 if self.last_seen is not None else None
+
+    @property
+    def checkpoint(self):
+        """The oldest update still in progress, or the offset once all of them are done."""
+        with self._changed:
+            if self.unfinished:
+                return min(self.unfinished)
+            return self.offset
+
+    def fetch(self, timeout, limit=None, offset=None):
+        data = {'timeout': timeout, 'limit': limit or self.limit, 'allowed_updates': ['message']}
+        offset = offset if offset is not None else self.offset
+        if offset is not None:
+            data['offset'] = offset
+        # the HTTP timeout must outlast the long poll
+        return self.bot.request.post(f"{self.bot.base_url}/getUpdates", data, timeout=timeout + 10)
+
+    def dispatch(self, updates):
+        """Dispatches the updates not seen before, returns their number."""
+        new_updates = [update_json for update_json in updates if is_valid_update(update_json)
+                       and (self.last_seen is None or update_json['update_id'] > self.last_seen)]
+        if self.pending is not None:
+            # saved before the next poll confirms them
+            self.pending.add(new_updates)
+        for update_json in new_updates:
+            if self.announce_update is not None:
+                self.announce_update(update_json)
+            with self._changed:
+                self.unfinished.add(update_json['update_id'])
+                self.last_seen = update_json['update_id']
+            self.dispatcher.dispatch(update_json)
+        return len(new_updates)
+
+    def finish(self, update_json):
+        if self.pending is not None:
+            self.pending.discard(update_json['update_id'])
+        with self._changed:
+            self.unfinished.discard(update_json['update_id'])
+            self._changed.notify_all()
+
+    def wait_until(self, predicate):
+        """Waits until the predicate holds or the worker is stopping."""
+        with self._changed:
+            while not predicate() and not self.stopping.is_set():
+                self._changed.wait(1)
+
+    def drain(self):
+        with self._changed:
+            self._changed.wait_for(lambda: not self.unfinished)
+        self.dispatcher.shutdown()
+
+    def commit(self):
+        """Confirms the updates before the checkpoint, Telegram delivers the last poll again otherwise."""
+        checkpoint = self.checkpoint
+        if checkpoint is None:
+            return
+        try:
+            self.fetch(timeout=0, limit=1, offset=checkpoint)
+            logger.info(f"Updates before {checkpoint} are confirmed")
+        except Exception as e:
+            logger.error(f"Offset {checkpoint} was not committed: {e}")
+
+    def replay(self):
+        """Dispatches the updates left in progress by the previous run."""
+        updates = list(self.pending.updates.values()) if self.pending is not None else []
+        if updates:
+            logger.info(f"{len(updates)} updates left in progress by the previous run are processed again")
+            self.dispatch(updates)
+
+    def run(self):
+        # getUpdates is refused while a webhook is set
+        self.bot.delete_webhook()
+        logger.info("Polling for updates")
+        try:
+            self.replay()
+            while not self.stopping.is_set():
+                self.wait_until(lambda: len(self.unfinished) < self.max_pending)
+                if self.stopping.is_set():
+                    break
+                try:
+                    # no more updates than there is room for
+                    limit = min(self.limit, max(1, self.max_pending - len(self.unfinished)))
+                    updates = self.fetch(self.poll_timeout, limit)
+                except Exception as e:
+                    logger.error(f"Polling failed: {e}")
+                    self.stopping.wait(self.retry_seconds)
+                    continue
+                self.dispatch(updates)
+        finally:
+            self.drain()
+            self.commit()
+        logger.info("Polling stopped")
+
+    def stop(self):
+        """Stops after the updates in progress, a pending long poll finishes first."""
+        self.stopping.set()
+
+    def handle_signal(self, signum, frame):
+        logger.info(f"Signal {signum} received, stopping")
+        self.stop()
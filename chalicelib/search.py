@@ -1,26 +1,100 @@
+import asyncio
 import concurrent.futures
 import csv
-import logging
+import json
 import os
-import time
+import re
+from functools import lru_cache
+from operator import attrgetter
 
 import pinecone
 from loguru import logger
 
-from chalicelib.utils import google_translate, generate_embedding, get_random_list_item, get_list, measure_time, \
-    extract_video_id
+from chalicelib.ann_index import AnnIndex
+from chalicelib.async_clients import async_google_translate, async_generate_embedding
+from chalicelib.lexical_index import LexicalIndex, LEXICAL_INDEX_PATH, analyze
+from chalicelib.tracing import span, traced, in_current_trace
+from chalicelib.utils import google_translate, generate_embedding, get_random_list_item, get_list, extract_video_id, \
+    google_translate_batch, generate_embeddings, chunked
 
-# Telegram token
-PINECONE_ENV = os.environ["PINECONE_ENV"]
-PINECONE_API_KEY = os.environ["PINECONE_API_KEY"]
-INDEX_NAME = os.environ["INDEX_NAME"]
+SEARCH_RESULTS_CACHE_PATH = "chalicelib/cache/search_results.json"
+# fields of a search result that are needed to render an answer
+CACHED_RESULT_FIELDS = ('id', 'relevance', 'text_relevance', 'meaning_relevance', 'url', 'title')
 
+ANSWER_SEPARATOR = "\n\n"
+format_answer_item = '👉 Из сатсанга ["{title}"]({url})'.format
+NO_RESULTS_ANSWER = "Ой, кажется, я не смог найти точный ответ на ваш вопрос 🤔 " \
+                    "Можете уточнить вопрос для более точного поиска? 🎯"
+LINK_TEXT_TRANSLATION = str.maketrans({'[': '(', ']': ')'})
+
+# runs the meaning query while the text query and the preliminary answer are in progress
+query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.environ.get("QUERY_THREADS", "8")))
+
+# Pinecone settings
+PINECONE_ENV = os.environ.get("PINECONE_ENV")
+PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
+INDEX_NAME = os.environ.get("INDEX_NAME")
+# a self-hosted vector index is used instead of Pinecone when set
+VECTOR_INDEX_PATH = os.environ.get("VECTOR_INDEX_PATH")
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", "32"))
+ANN_RERANK = int(os.environ.get("ANN_RERANK", "4"))
+
+# short queries are answered without an embedding when the best lexical match contains the query
+# terms and stands out from the next one: its coverage times its BM25 margin is at least this
+LEXICAL_FAST_PATH_CONFIDENCE = float(os.environ.get("LEXICAL_FAST_PATH_CONFIDENCE", "0.5"))
+LEXICAL_FAST_PATH_MAX_TERMS = int(os.environ.get("LEXICAL_FAST_PATH_MAX_TERMS", "2"))
+# share of the lexical score in the text relevance, 0 turns the fusion off
+LEXICAL_FUSION_WEIGHT = float(os.environ.get("LEXICAL_FUSION_WEIGHT", "0.3"))
+# lexical matches of the latest queries, the fast path check and the search look up the same query
+LEXICAL_CACHE_SIZE = 256
+
+
+class SearchCancelled(Exception):
+    pass
+
+
+class SearchHit:
+    """A ranked text chunk.
+
+    Ranking only needs the ids and scores, `title` and `url` are filled in by `TextSearch.describe`
+    for the hits that are shown. Fields can also be read by key, like the cached result dicts.
+    """
+    __slots__ = ('id', 'meaning_id', 'relevance', 'text_relevance', 'meaning_relevance', 'metadata', 'title', 'url')
+
+    def __init__(self, hit_id, meaning_id, relevance, text_relevance, meaning_relevance, metadata):
+        self.id = hit_id
+        self.meaning_id = meaning_id
+        self.relevance = relevance
+        self.text_relevance = text_relevance
+        self.meaning_relevance = meaning_relevance
+        self.metadata = metadata
+        self.title = None
+        self.url = None
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __repr__(self):
+        return f"SearchHit({self.id!r}, relevance={self.relevance!r})"
+
+
+def record_video_id(record_id):
+    """The video id of a meaning or text id, "<video_id>-t<start>[-c]"; video ids may contain dashes."""
+    match = re.match(r"(.*)-t\d", record_id)
+    return match.group(1) if match else record_id
 
 
 class TextSearch:
-    def __init__(self):
-        self.index = self.load_index()
-        self.titles = self.load_titles()
+    # number of top text to be retrieved from database
+    TOP_TEXTS_COUNT = 20
+    # assumed to be less than that
+    MAX_MEANINGS_COUNT = 1600
+
+    def __init__(self, index=None, titles=None, lexical_index=None):
+        self.index = index if index is not None else self.load_index()
+        self.titles = titles if titles is not None else self.load_titles()
+        self.lexical_index = lexical_index if lexical_index is not None else LexicalIndex.load(LEXICAL_INDEX_PATH)
+        self.lexical_matches = lru_cache(maxsize=LEXICAL_CACHE_SIZE)(self.query_lexical_index)
 
     @staticmethod
     def load_titles():
@@ -37,6 +111,8 @@ class TextSearch:
 
     @staticmethod
     def load_index():
+        if VECTOR_INDEX_PATH:
+            return AnnIndex.load(VECTOR_INDEX_PATH, nprobe=ANN_NPROBE, rerank=ANN_RERANK)
         pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENV)
         index = pinecone.Index(INDEX_NAME)
         index.describe_index_stats()
@@ -75,62 +151,113 @@ class TextSearch:
 
         return {'matches': meanings}
 
-    def search(self, query_embedding, top_k=5):
-        # number of top text to be retrieved from database
-        top_texts_count = 20
-        # assumed to be less than that
-        max_meanings_count = 1600
-
-        start_time = time.time()
-        similar_texts = self.index.query(query_embedding, namespace="text", top_k=top_texts_count,
-                                         include_metadata=True)
-
-        end_time = time.time()
-        execution_time = end_time - start_time
-        logger.info(f"Execution time of the similar_texts query: {execution_time} seconds")
-
-        start_time = time.time()
-        similar_meanings = self.index.query(query_embedding, namespace="meaning", top_k=max_meanings_count,
-                                            include_metadata=False)
-        # similar_meanings = self.search_similar_meanings_parallel(query_embedding=query_embedding,
-        #                                                          max_meanings_count=max_meanings_count)
-        end_time = time.time()
-        execution_time = end_time - start_time
-        logging.info(f"Execution time of the similar_meanings query: {execution_time} seconds")
-
-        start_time = time.time()
-        ordered_texts = self.order_by_joint_relevance(similar_texts, similar_meanings)
-        end_time = time.time()
-        execution_time = end_time - start_time
-        logger.info(f"order_by_joint_relevance execution time: {execution_time} seconds")
-
-        start_time = time.time()
-        top_texts = {}
-        for text in ordered_texts:
-            video_id = text['id'].split('-')[0]
-            if video_id not in top_texts or text['relevance'] > top_texts[video_id]['relevance']:
-                top_texts[video_id] = text
-
-        sorted_result = sorted(top_texts.values(), key=lambda x: x['relevance'], reverse=True)[:top_k]
-        end_time = time.time()
-        execution_time = end_time - start_time
-        logging.info(f"Execution time of the filter out duplication code: {execution_time} seconds")
-
-        return sorted_result
-
-    @staticmethod
-    def _compute_text_score(text, similar_meanings):
-        metadata = text["metadata"]
+    @traced("index.text_query")
+    def query_texts(self, query_embedding, top_texts_count):
+        return self.index.query(query_embedding, namespace="text", top_k=top_texts_count, include_metadata=True)
+
+    @traced("index.meaning_query")
+    def query_meanings(self, query_embedding, max_meanings_count):
+        return self.index.query(query_embedding, namespace="meaning", top_k=max_meanings_count,
+                                include_metadata=False)
+        # return self.search_similar_meanings_parallel(query_embedding=query_embedding,
+        #                                              max_meanings_count=max_meanings_count)
+
+    def search(self, query_embedding, top_k=5, on_texts=None, query=None):
+        """Ranks texts by joint text and meaning relevance.
+
+        `on_texts` is called with the best text-relevance hit as soon as the text query is done,
+        while the meaning query may still be running. With the query text given, lexical matches
+        are fused into the text matches.
+        """
+        meanings_future = query_executor.submit(in_current_trace(self.query_meanings), query_embedding,
+                                                self.MAX_MEANINGS_COUNT)
+        similar_texts = self.query_texts(query_embedding, self.TOP_TEXTS_COUNT)
+        if query is not None and self.lexical_index is not None and LEXICAL_FUSION_WEIGHT:
+            similar_texts = self.fuse_lexical(query, similar_texts)
+        if on_texts is not None and similar_texts['matches']:
+            on_texts(self.preliminary_result(similar_texts['matches'][0]))
+        similar_meanings = meanings_future.result()
+
+        ordered_hits = self.order_by_joint_relevance(similar_texts, similar_meanings)
+        return self.describe(self.top_per_video(ordered_hits, top_k))
+
+    async def search_async(self, query_embedding, top_k=5, on_texts=None, query=None):
+        """Asyncio version of `search`, `on_texts` is a coroutine function.
+
+        The index client blocks, its queries run on the executor of the event loop.
+        """
+        meanings_task = asyncio.create_task(asyncio.to_thread(self.query_meanings, query_embedding,
+                                                              self.MAX_MEANINGS_COUNT))
         try:
-            meaning_id = metadata["meaning_id"]
-        except KeyError:
-            logger.info(f"KeyError occurred for text with id: {text['id']}")
-        else:
-            for chapter in similar_meanings["matches"]:
-                if chapter['id'] == meaning_id:
-                    return chapter['score']
+            similar_texts = await asyncio.to_thread(self.query_texts, query_embedding, self.TOP_TEXTS_COUNT)
+            if query is not None and self.lexical_index is not None and LEXICAL_FUSION_WEIGHT:
+                similar_texts = self.fuse_lexical(query, similar_texts)
+            if on_texts is not None and similar_texts['matches']:
+                await on_texts(self.preliminary_result(similar_texts['matches'][0]))
+            similar_meanings = await meanings_task
+        finally:
+            meanings_task.cancel()
+
+        ordered_hits = self.order_by_joint_relevance(similar_texts, similar_meanings)
+        return self.describe(self.top_per_video(ordered_hits, top_k))
 
+    @staticmethod
+    def top_per_video(hits, top_k):
+        with span("dedupe"):
+            top_hits = {}
+            for hit in hits:
+                video_id = record_video_id(hit.id)
+                if video_id not in top_hits or hit.relevance > top_hits[video_id].relevance:
+                    top_hits[video_id] = hit
+
+            return sorted(top_hits.values(), key=attrgetter('relevance'), reverse=True)[:top_k]
+
+    def query_lexical_index(self, query):
+        """The best `TOP_TEXTS_COUNT` lexical matches, read through `lexical_matches`."""
+        if self.lexical_index is None:
+            return ()
+        return tuple(self.lexical_index.search(query, self.TOP_TEXTS_COUNT))
+
+    def fuse_lexical(self, query, texts):
+        """Adds the lexical candidates to the text matches and mixes both scores.
+
+        A chunk missing from the vector matches gets the lowest vector score among them, one
+        missing from the lexical matches gets 0.
+        """
+        vector_matches = {text['id']: text for text in texts['matches']}
+        lexical_matches = {text['id']: text for text in self.lexical_matches(query)}
+        vector_floor = min((text['score'] for text in texts['matches']), default=0.0)
+
+        fused = []
+        for text_id in vector_matches.keys() | lexical_matches.keys():
+            vector_match, lexical_match = vector_matches.get(text_id), lexical_matches.get(text_id)
+            vector_score = vector_match['score'] if vector_match else vector_floor
+            lexical_score = lexical_match['score'] if lexical_match else 0.0
+            fused.append({
+                'id': text_id,
+                'score': (1 - LEXICAL_FUSION_WEIGHT) * vector_score + LEXICAL_FUSION_WEIGHT * lexical_score,
+                'metadata': (vector_match or lexical_match)['metadata'],
+            })
+        fused.sort(key=lambda text: text['score'], reverse=True)
+        return {'matches': fused}
+
+    def lexical_fast_path(self, query, top_k=5):
+        """Returns the results of a keyword-like query the lexical index is confident about, or None."""
+        if self.lexical_index is None or len(set(analyze(query))) > LEXICAL_FAST_PATH_MAX_TERMS:
+            return None
+        matches = self.lexical_matches(query)
+        if not matches:
+            return None
+        # a term found in many satsangs alike says little about which of them is meant, the chunks of
+        # the best one share its title and do not count against it
+        best_video_id = record_video_id(matches[0]['id'])
+        runner_up = next((text['bm25'] for text in matches[1:] if record_video_id(text['id']) != best_video_id), 0.0)
+        confidence = matches[0]['coverage'] * (1 - runner_up / matches[0]['bm25'])
+        if confidence < LEXICAL_FAST_PATH_CONFIDENCE:
             return None
+        hits = [SearchHit(text['id'], text['metadata']['meaning_id'], text['score'], text['score'], None,
+                          text['metadata']) for text in matches]
+        return self.describe(self.top_per_video(hits, top_k))
 
     def generate_title(self, video_id, metadata):
         title = ""
@@ -140,68 +267,263 @@ class TextSearch:
             title = self.titles[video_id]
         return title
 
+    def preliminary_result(self, text):
+        metadata = text['metadata']
+        hit = SearchHit(text['id'], metadata.get('meaning_id', ''), None, text['score'], None, metadata)
+        return self.describe([hit])[0]
+
+    def describe(self, hits):
+        """Fills in the display fields of the hits."""
+        for hit in hits:
+            metadata = hit.metadata
+            hit.url = f"{metadata['url']}&t={int(metadata['start'])}"
+            hit.title = self.generate_title(record_video_id(hit.meaning_id), metadata)
+        return hits
+
+    @traced("ranking")
     def order_by_joint_relevance(self, texts, meanings):
-        import re
-        mapped_results = []
+        # only the meanings of the candidate texts are looked up, in a single pass
+        wanted = {text['metadata'].get('meaning_id') for text in texts['matches']}
+        meaning_scores = {}
+        for meaning in meanings['matches']:
+            if meaning['id'] in wanted and meaning['id'] not in meaning_scores:
+                meaning_scores[meaning['id']] = meaning['score']
+                if len(meaning_scores) == len(wanted):
+                    break
+
+        hits = []
         for text in texts['matches']:
-            text_relevance = text['score']
-            meaning_relevance = self._compute_text_score(text, meanings)
-            if meaning_relevance is not None:
-                meaning_id = text['metadata']['meaning_id']
-                video_id = re.match(r"(.*?)-t", meaning_id).group(1) if re.match(r"(.*?)-t", meaning_id) else None
-                mapped_results.append({
-                    'id': text['id'],
-                    'meaning_id': meaning_id,
-                    'relevance': 0.4 * text_relevance + 0.6 * meaning_relevance,
-                    'text_relevance': text_relevance,
-                    'meaning_relevance': meaning_relevance,
-                    'text': text['metadata']['text'],
-                    'url': f"{text['metadata']['url']}&t={int(text['metadata']['start'])}",
-                    'start': text['metadata']['start'],
-                    'title': self.generate_title(video_id, text['metadata']),
-                    'published': str(text['metadata']['published'])
-                })
-            else:
+            meaning_id = text['metadata'].get('meaning_id')
+            meaning_relevance = meaning_scores.get(meaning_id)
+            if meaning_relevance is None:
                 logger.warning(f"Meaning relevance is not defined {text['id']}")
-        sorted_result = sorted(mapped_results, key=lambda t: t['relevance'], reverse=True)
-        return sorted_result
+                continue
+            text_relevance = text['score']
+            hits.append(SearchHit(text['id'], meaning_id, 0.4 * text_relevance + 0.6 * meaning_relevance,
+                                  text_relevance, meaning_relevance, text['metadata']))
+        hits.sort(key=attrgetter('relevance'), reverse=True)
+        return hits
 
 
-text_search = TextSearch()
+_text_search = None
 
 
-@measure_time
-def search(query):
-    def get_random_response():
-        return get_random_list_item('chalicelib/ui/ui_results.json')
+def get_text_search():
+    global _text_search
+    if _text_search is None:
+        _text_search = TextSearch()
+    return _text_search
 
-    def get_random_next_question():
-        return get_random_list_item('chalicelib/ui/ui_next_question.json')
 
-    logger.info(f"User query: {query}")
+def set_text_search(text_search):
+    global _text_search
+    _text_search = text_search
 
-    top_k = 3
+
+_cached_results = None
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split()).strip(" ?!.")
+
+
+def load_cached_results(file_path=SEARCH_RESULTS_CACHE_PATH):
+    try:
+        with open(file_path, 'r') as f:
+            content = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return content['responses']
+
+
+def get_cached_results(query):
+    global _cached_results
+    if _cached_results is None:
+        _cached_results = load_cached_results()
+    return _cached_results.get(normalize_query(query))
+
+
+def compact_result(result):
+    return {field: result[field] for field in CACHED_RESULT_FIELDS}
+
+
+def get_random_response():
+    return get_random_list_item('chalicelib/ui/ui_results.json')
+
+
+def get_random_next_question():
+    return get_random_list_item('chalicelib/ui/ui_next_question.json')
+
+
+def get_random_preliminary_text():
+    return get_random_list_item('chalicelib/ui/ui_preliminary.json')
+
+
+def escape_link_text(text):
+    # legacy Markdown has no escaping inside a link, a bracket would end its text early
+    return text.translate(LINK_TEXT_TRANSLATION)
+
+
+def render_preliminary_answer(result):
+    return ANSWER_SEPARATOR.join([get_random_preliminary_text(), render_answer_item(result)])
+
+
+def render_answer_item(result):
+    return format_answer_item(title=escape_link_text(result['title']), url=result['url'])
+
+
+@traced("render")
+def render_answer(results):
+    if not results:
+        return NO_RESULTS_ANSWER
+    return ANSWER_SEPARATOR.join([get_random_response(), *map(render_answer_item, results),
+                                  get_random_next_question()])
+
+
+def raise_if_cancelled(is_cancelled):
+    if is_cancelled is not None and is_cancelled():
+        raise SearchCancelled()
+
+
+def needs_embedding(query):
+    return get_cached_results(query) is None and get_text_search().lexical_fast_path(query) is None
+
+
+def embed_query(query, is_cancelled=None):
+    raise_if_cancelled(is_cancelled)
     processed_query = google_translate(query, "ru", "en")
 
+    raise_if_cancelled(is_cancelled)
     logger.info(f"Embedding model Open AI is used for search")
     query_embedding, tokens_count = generate_embedding(processed_query)
     logger.info(f"Number of tokens to build an embedding for a user query: {tokens_count}")
+    return query_embedding
 
-    results = text_search.search(query_embedding, top_k)
-    next_question = get_random_next_question()
 
-    logger.info(f"Results: {len(results)}")
+async def embed_query_async(query, is_cancelled=None):
+    raise_if_cancelled(is_cancelled)
+    processed_query = await async_google_translate(query, "ru", "en")
+
+    raise_if_cancelled(is_cancelled)
+    query_embedding, tokens_count = await async_generate_embedding(processed_query)
+    logger.info(f"Number of tokens to build an embedding for a user query: {tokens_count}")
+    return query_embedding
+
+
+@traced("search")
+def search(query, on_preliminary=None, is_cancelled=None, embedding_future=None):
+    """Returns the Markdown answer to the query.
+
+    With `on_preliminary` set, it is called with a preliminary answer built from the best text
+    match before the final ranking is done. `is_cancelled` is checked before every expensive
+    stage, SearchCancelled is raised once it returns True. `embedding_future` is an already
+    started `embed_query` of the same query.
+    """
+    logger.info(f"User query: {query}")
+
+    top_k = 3
+    cached_results = get_cached_results(query)
+    if cached_results is not None:
+        logger.info(f"Precomputed results are used for the query")
+        return render_answer(cached_results[:top_k])
+
+    text_search = get_text_search()
+    lexical_results = text_search.lexical_fast_path(query, top_k)
+    if lexical_results is not None:
+        logger.info(f"Lexical results are used for the query")
+        if embedding_future is not None:
+            embedding_future.cancel()
+        return render_answer(lexical_results)
+
+    if embedding_future is not None:
+        query_embedding = embedding_future.result()
+    else:
+        query_embedding = embed_query(query, is_cancelled)
+
+    raise_if_cancelled(is_cancelled)
+    on_texts = None
+    if on_preliminary is not None:
+        def on_texts(result):
+            on_preliminary(render_preliminary_answer(result))
+
+    results = text_search.search(query_embedding, top_k, on_texts=on_texts, query=query)
 
+    logger.info(f"Results: {len(results)}")
     if len(results) > 0:
-        logger.info(f"Top result: text relevance {results[0]['text_relevance']}, "
-                    f"meaning relevance {results[0]['meaning_relevance']}")
-        answer = '{}\n\n'.format(get_random_response())
-        for result in results:
-            answer += f'👉 Из сатсанга ["{result["title"]}"]({result["url"]})\n\n'
-        answer += next_question
+        logger.info(f"Top result: text relevance {results[0].text_relevance}, "
+                    f"meaning relevance {results[0].meaning_relevance}")
+
+    return render_answer(results)
+
+
+@traced("search")
+async def search_async(query, on_preliminary=None, is_cancelled=None, embedding_task=None):
+    """Asyncio version of `search`, `on_preliminary` is a coroutine function and `embedding_task`
+    an already started `embed_query_async` of the same query.
+    """
+    logger.info(f"User query: {query}")
 
+    top_k = 3
+    cached_results = get_cached_results(query)
+    if cached_results is not None:
+        logger.info(f"Precomputed results are used for the query")
+        return render_answer(cached_results[:top_k])
+
+    # the first call loads the index
+    text_search = await asyncio.to_thread(get_text_search)
+    lexical_results = text_search.lexical_fast_path(query, top_k)
+    if lexical_results is not None:
+        logger.info(f"Lexical results are used for the query")
+        if embedding_task is not None:
+            embedding_task.cancel()
+        return render_answer(lexical_results)
+
+    if embedding_task is not None:
+        query_embedding = await embedding_task
     else:
-        answer = "Ой, кажется, я не смог найти точный ответ на ваш вопрос 🤔 " \
-                 "Можете уточнить вопрос для более точного поиска? 🎯"
+        query_embedding = await embed_query_async(query, is_cancelled)
+
+    raise_if_cancelled(is_cancelled)
+    on_texts = None
+    if on_preliminary is not None:
+        async def on_texts(result):
+            await on_preliminary(render_preliminary_answer(result))
+
+    results = await text_search.search_async(query_embedding, top_k, on_texts=on_texts, query=query)
 
-    return answer
+    logger.info(f"Results: {len(results)}")
+    if len(results) > 0:
+        logger.info(f"Top result: text relevance {results[0].text_relevance}, "
+                    f"meaning relevance {results[0].meaning_relevance}")
+
+    return render_answer(results)
+
+
+def batch_search(queries, top_k=3, batch_size=100, max_workers=8):
+    """Search many queries at once.
+
+    Queries without a confident lexical match are translated in parallel and embedded in chunks of
+    `batch_size` per API call, index queries run on at most `max_workers` threads. Returns the ranked
+    results of every query in the input order.
+    """
+    queries = list(queries)
+    text_search = get_text_search()
+    results = [text_search.lexical_fast_path(query, top_k) for query in queries]
+    pending = [position for position, result in enumerate(results) if result is None]
+
+    embeddings = []
+    tokens_count = 0
+    for batch in chunked([queries[position] for position in pending], batch_size):
+        processed_queries = google_translate_batch(batch, "ru", "en")
+        batch_embeddings, batch_tokens = generate_embeddings(processed_queries)
+        embeddings.extend(batch_embeddings)
+        tokens_count += batch_tokens
+    logger.info(f"Number of tokens to build embeddings for {len(pending)} queries: {tokens_count}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        searched = executor.map(lambda position, embedding: text_search.search(embedding, top_k,
+                                                                                query=queries[position]),
+                                pending, embeddings)
+        for position, result in zip(pending, searched):
+            results[position] = result
+    return results
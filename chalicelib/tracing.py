@@ -0,0 +1,217 @@
+import contextvars
+import inspect
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+
+from loguru import logger
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "DanielSearchBot")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+HISTOGRAM_LOG_INTERVAL = int(os.environ.get("HISTOGRAM_LOG_INTERVAL", "100"))
+
+
+def nearest_rank(ordered, p):
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+class Histogram:
+    """Keeps the most recent samples of a stage to estimate its latency percentiles."""
+
+    def __init__(self, size=2048):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        with self._lock:
+            self.samples.append(value)
+            self.count += 1
+            self.total += value
+
+    def percentile(self, p):
+        with self._lock:
+            ordered = sorted(self.samples)
+        return nearest_rank(ordered, p) if ordered else None
+
+    def summary(self):
+        with self._lock:
+            ordered = sorted(self.samples)
+            count, total = self.count, self.total
+        if not ordered:
+            return {'count': 0}
+
+        return {
+            'count': count,
+            'mean': total / count,
+            'p50': nearest_rank(ordered, 50),
+            'p95': nearest_rank(ordered, 95),
+            'p99': nearest_rank(ordered, 99),
+            'max': ordered[-1],
+        }
+
+
+class Trace:
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, stage, duration_ms):
+        with self._lock:
+            self.spans[stage].append(duration_ms)
+
+
+class Tracer:
+    def __init__(self, namespace=METRICS_NAMESPACE, sample_rate=TRACE_SAMPLE_RATE, emit=None):
+        self.namespace = namespace
+        self.sample_rate = sample_rate
+        self.emit = emit or self._print_line
+        self.histograms = defaultdict(Histogram)
+        self.traces_count = 0
+        self._histograms_lock = threading.Lock()
+        self._current = contextvars.ContextVar("trace", default=None)
+
+    @staticmethod
+    def _print_line(line):
+        # EMF lines must reach stdout verbatim, loguru would prefix them
+        print(line, flush=True)
+
+    def _is_sampled(self):
+        trace = self._current.get()
+        if trace is not None:
+            return trace.sampled
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def current_trace_id(self):
+        trace = self._current.get()
+        return trace.trace_id if trace else None
+
+    def histogram(self, stage):
+        with self._histograms_lock:
+            return self.histograms[stage]
+
+    def snapshot(self):
+        with self._histograms_lock:
+            stages = list(self.histograms.items())
+        return {stage: histogram.summary() for stage, histogram in stages}
+
+    def reset(self):
+        with self._histograms_lock:
+            self.histograms.clear()
+            self.traces_count = 0
+
+    @contextmanager
+    def trace(self, trace_id):
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        trace = Trace(trace_id, sampled)
+        token = self._current.set(trace)
+        start = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            self._current.reset(token)
+            if sampled:
+                trace.add("total", (time.perf_counter() - start) * 1000)
+                self._finish(trace)
+
+    @contextmanager
+    def span(self, stage):
+        if not self._is_sampled():
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            trace = self._current.get()
+            if trace is not None:
+                trace.add(stage, duration_ms)
+            else:
+                self.histogram(stage).record(duration_ms)
+            logger.debug(f"{stage} took {duration_ms:.1f} ms")
+
+    def _finish(self, trace):
+        for stage, durations in trace.spans.items():
+            histogram = self.histogram(stage)
+            for duration in durations:
+                histogram.record(duration)
+
+        self.emit(self.to_emf(trace))
+
+        with self._histograms_lock:
+            self.traces_count += 1
+            log_histograms = HISTOGRAM_LOG_INTERVAL and self.traces_count % HISTOGRAM_LOG_INTERVAL == 0
+        if log_histograms:
+            logger.info(f"Stage latency histograms (ms): {self.snapshot()}")
+
+    def to_emf(self, trace):
+        """Render a finished trace as a CloudWatch Embedded Metric Format log line."""
+        metrics = []
+        payload = {}
+        for stage, durations in trace.spans.items():
+            metrics.append({'Name': stage, 'Unit': 'Milliseconds'})
+            payload[stage] = durations[0] if len(durations) == 1 else durations
+
+        return json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Environment']],
+                    'Metrics': metrics,
+                }],
+            },
+            'Environment': os.environ.get("STAGE", "unknown"),
+            'UpdateId': trace.trace_id,
+            **payload,
+        })
+
+
+tracer = Tracer()
+
+
+def span(stage):
+    return tracer.span(stage)
+
+
+def in_current_trace(func):
+    """Wraps func to record its spans into the current trace when it runs on another thread."""
+    context = contextvars.copy_context()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def traced(stage=None):
+    def decorator(func):
+        name = stage or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+import boto3
+from loguru import logger
+
+from chalicelib.tracing import traced
+
+
+def chat_id_of(update_json):
+    for key in ('message', 'edited_message', 'callback_query'):
+        item = update_json.get(key)
+        if item:
+            message = item.get('message', item)
+            return message.get('chat', {}).get('id')
+    return None
+
+
+def is_valid_update(update_json):
+    return isinstance(update_json, dict) and isinstance(update_json.get('update_id'), int)
+
+
+class SqsUpdateQueue:
+    def __init__(self, queue_name):
+        self.queue_name = queue_name
+        self.fifo = queue_name.endswith(".fifo")
+        self.sqs = boto3.client('sqs')
+        self._queue_url = None
+
+    @property
+    def queue_url(self):
+        if self._queue_url is None:
+            self._queue_url = self.sqs.get_queue_url(QueueName=self.queue_name)['QueueUrl']
+        return self._queue_url
+
+    @traced("sqs.enqueue")
+    def enqueue(self, update_json):
+        params = {'QueueUrl': self.queue_url, 'MessageBody': json.dumps(update_json)}
+        if self.fifo:
+            # FIFO queues keep the order of every chat and drop re-delivered updates
+            params['MessageGroupId'] = str(chat_id_of(update_json) or update_json['update_id'])
+            params['MessageDeduplicationId'] = str(update_json['update_id'])
+        self.sqs.send_message(**params)
+
+
+class InMemoryUpdateQueue:
+    """Stand-in for the SQS queue in the local stage and tests."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def enqueue(self, update_json):
+        self._queue.put(json.dumps(update_json))
+
+    def receive(self, max_messages=10, wait_seconds=1.0):
+        try:
+            messages = [self._queue.get(timeout=wait_seconds)]
+        except queue.Empty:
+            return []
+        while len(messages) < max_messages:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def task_done(self, count=1):
+        for _ in range(count):
+            self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+
+def group_by_chat(updates):
+    """Splits updates into lists of one chat each, keeping their order."""
+    updates = sorted(enumerate(updates), key=lambda item: (str(chat_id_of(item[1])), item[0]))
+    return [[update for _, update in group] for _, group in groupby(updates, key=lambda item: str(chat_id_of(item[1])))]
+
+
+def process_batch(updates, process_update, max_workers=4):
+    """Process a batch of update dicts, in parallel across chats and in order within a chat.
+
+    Returns the updates that failed.
+    """
+    chats = group_by_chat(updates)
+
+    def process_chat(chat_updates):
+        failed = []
+        for update_json in chat_updates:
+            try:
+                process_update(update_json)
+            except Exception as e:
+                logger.error(f"Processing of update {update_json.get('update_id')} failed: {e}")
+                failed.append(update_json)
+        return failed
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [update for failed in executor.map(process_chat, chats) for update in failed]
+
+
+async def process_batch_async(updates, process_update, max_concurrency=64):
+    """Asyncio version of `process_batch`, `process_update` is a coroutine function."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def process_chat(chat_updates):
+        failed = []
+        async with semaphore:
+            for update_json in chat_updates:
+                try:
+                    await process_update(update_json)
+                except Exception as e:
+                    logger.error(f"Processing of update {update_json.get('update_id')} failed: {e}")
+                    failed.append(update_json)
+        return failed
+
+    results = await asyncio.gather(*(process_chat(chat_updates) for chat_updates in group_by_chat(updates)))
+    return [update for failed in results for update in failed]
+
+
+class LocalUpdateWorker:
+    """Consumes an InMemoryUpdateQueue in batches on a background thread."""
+
+    def __init__(self, update_queue, process_update, batch_size=10, max_workers=4, process_batch=process_batch):
+        self.update_queue = update_queue
+        self.process_update = process_update
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.process_batch = process_batch
+        self.done = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.done:
+            messages = self.update_queue.receive(self.batch_size)
+            if not messages:
+                continue
+            try:
+                self.process_batch([json.loads(message) for message in messages], self.process_update,
+                                   self.max_workers)
+            finally:
+                self.update_queue.task_done(len(messages))
+
+    def stop(self):
+        self.done = True
+        self.thread.join()
@@ -3,6 +3,7 @@ import os
 import random
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
 import boto3
@@ -10,7 +11,31 @@ import openai
 import wget
 from googletrans import Translator
 from loguru import logger
-from telegram import ChatAction
+from telegram import Bot, ChatAction
+
+from chalicelib.idempotency import record_side_effect
+from chalicelib.tracing import traced
+
+
+class TracedBot(Bot):
+    @traced("telegram.send_message")
+    def send_message(self, *args, **kwargs):
+        record_side_effect()
+        return super().send_message(*args, **kwargs)
+
+    @traced("telegram.send_photo")
+    def send_photo(self, *args, **kwargs):
+        record_side_effect()
+        return super().send_photo(*args, **kwargs)
+
+    @traced("telegram.edit_message_caption")
+    def edit_message_caption(self, *args, **kwargs):
+        record_side_effect()
+        return super().edit_message_caption(*args, **kwargs)
+
+    @traced("telegram.send_chat_action")
+    def send_chat_action(self, *args, **kwargs):
+        return super().send_chat_action(*args, **kwargs)
 
 
 class TypingThread(Thread):
@@ -72,17 +97,41 @@ def generate_transcription(file):
     return output["results"]["transcripts"][0]["transcript"]
 
 
+@traced("translate")
 def google_translate(text: str, src: str, target: str):
     translator = Translator()
     translation = translator.translate(text, src=src, dest=target)
     return translation.text
 
 
+@traced("translate.batch")
+def google_translate_batch(texts: list, src: str, target: str, max_workers=8):
+    # googletrans sends one request per text even for a list, the requests run in parallel instead
+    def translate(text):
+        return Translator().translate(text, src=src, dest=target).text
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(translate, texts))
+
+
+@traced("embed")
 def generate_embedding(_text: str):
     response = openai.Embedding.create(model="text-embedding-ada-002", input=_text)
     return response["data"][0]["embedding"], response["usage"]["total_tokens"]
 
 
+@traced("embed.batch")
+def generate_embeddings(texts: list):
+    response = openai.Embedding.create(model="text-embedding-ada-002", input=list(texts))
+    data = sorted(response["data"], key=lambda item: item["index"])
+    return [item["embedding"] for item in data], response["usage"]["total_tokens"]
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
 def generate_random_image_url():
     s3_client = boto3.client('s3')
 
@@ -105,18 +154,6 @@ def generate_random_image_url():
     return url
 
 
-def measure_time(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
-        print(f"Execution time of the function {func.__name__}: {execution_time} sec")
-        return result
-
-    return wrapper
-
-
 def get_random_list_item(file_path):
     return random.choice(get_list(file_path))
 
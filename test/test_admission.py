@@ -0,0 +1,71 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from chalicelib.admission import AdmissionController, ServiceSwitch
+
+
+class TestAdmission(unittest.TestCase):
+    def test_in_flight_limit(self):
+        controller = AdmissionController(max_in_flight=2)
+        first, second = controller.try_acquire(), controller.try_acquire()
+
+        self.assertIsNone(controller.try_acquire())
+        first.release()
+        self.assertIsNotNone(controller.try_acquire())
+        second.release()
+
+    @patch('chalicelib.admission.time.monotonic')
+    def test_errors_open_circuit_until_probe_succeeds(self, monotonic):
+        monotonic.return_value = 100.0
+        controller = AdmissionController(max_error_rate=0.5, cooldown_seconds=30, min_samples=2)
+        for _ in range(2):
+            admission = controller.try_acquire()
+            admission.record(100.0, failed=True)
+            admission.release()
+
+        self.assertIsNone(controller.try_acquire())
+
+        monotonic.return_value = 131.0
+        probe = controller.try_acquire()
+        self.assertIsNotNone(probe)
+        self.assertIsNone(controller.try_acquire())
+        probe.record(131.0)
+        probe.release()
+
+        self.assertIsNotNone(controller.try_acquire())
+
+    @patch('chalicelib.admission.time.monotonic')
+    def test_slow_searches_open_circuit(self, monotonic):
+        monotonic.return_value = 0.0
+        controller = AdmissionController(max_p95_latency_ms=1000, min_samples=2)
+        for _ in range(2):
+            admission = controller.try_acquire()
+            started = monotonic.return_value
+            monotonic.return_value += 2.0
+            admission.record(started)
+            admission.release()
+
+        self.assertIsNone(controller.try_acquire())
+
+    @patch('chalicelib.admission.time.monotonic')
+    def test_requests_without_search_are_no_samples(self, monotonic):
+        monotonic.return_value = 0.0
+        controller = AdmissionController(max_error_rate=0.5, min_samples=3)
+        for searched in [True, True] + [False] * 10 + [True]:
+            admission = controller.try_acquire()
+            if searched:
+                admission.record(0.0, failed=True)
+            # quota denials end before the search
+            admission.release()
+
+        self.assertIsNone(controller.try_acquire())
+
+    def test_service_switch_caches_state(self):
+        dao = MagicMock()
+        dao.is_available.return_value = None
+        switch = ServiceSwitch(dao, default_available=False, ttl_seconds=60)
+
+        self.assertFalse(switch.is_on())
+        dao.is_available.return_value = True
+        self.assertFalse(switch.is_on())
+        self.assertEqual(dao.is_available.call_count, 1)
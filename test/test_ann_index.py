@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from chalicelib.ann_index import AnnIndex
+from chalicelib.local_index import LocalIndex
+from chalicelib.search import TextSearch
+
+
+def clustered_index(count=3000, dimension=32, seed=3):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(30, dimension))
+    vectors = centers[rng.integers(0, len(centers), count)] + rng.normal(scale=0.5, size=(count, dimension))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = LocalIndex()
+    index.upsert([(f"video{i}-t0-c", vector.tolist(), {'group': i % 3}) for i, vector in enumerate(vectors)],
+                 namespace="text")
+    queries = vectors[rng.integers(0, count, 50)] + rng.normal(scale=0.2, size=(50, dimension))
+    return index, queries.tolist()
+
+
+class TestAnnIndex(unittest.TestCase):
+    def setUp(self):
+        self.exact_index, self.queries = clustered_index()
+        self.path = tempfile.TemporaryDirectory()
+        AnnIndex.build(self.exact_index).save(self.path.name)
+
+    def tearDown(self):
+        self.path.cleanup()
+
+    def exact_ids(self, query, **kwargs):
+        response = self.exact_index.query(query, namespace="text", top_k=10, **kwargs)
+        return [match['id'] for match in response['matches']]
+
+    def test_recall_against_exact_search(self):
+        index = AnnIndex.load(self.path.name)
+
+        recalls = []
+        for query in self.queries:
+            found = {match['id'] for match in index.query(query, namespace="text", top_k=10)['matches']}
+            recalls.append(len(found & set(self.exact_ids(query))) / 10)
+
+        self.assertIsInstance(index.namespaces["text"].codes, np.memmap)
+        self.assertEqual(index.namespaces["text"].codes.dtype, np.int8)
+        self.assertGreater(np.mean(recalls), 0.9)
+
+    def test_probing_every_list_is_exact(self):
+        index = AnnIndex.load(self.path.name, nprobe=10000, rerank=1000)
+        query = self.queries[0]
+        group_filter = {'group': {'$eq': 1}}
+
+        response = index.query(query, namespace="text", top_k=10, include_metadata=True, filter=group_filter)
+
+        self.assertEqual([match['id'] for match in response['matches']], self.exact_ids(query, filter=group_filter))
+        self.assertTrue(all(match['metadata'] == {'group': 1} for match in response['matches']))
+        self.assertEqual(index.query(query, namespace="meaning")['matches'], [])
+
+    def test_text_search_uses_local_vector_index(self):
+        with patch('chalicelib.search.VECTOR_INDEX_PATH', self.path.name), \
+                patch('chalicelib.search.pinecone') as mock_pinecone:
+            text_search = TextSearch(titles={})
+
+        self.assertIsInstance(text_search.index, AnnIndex)
+        mock_pinecone.init.assert_not_called()
@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import itertools
+import unittest
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from telegram import Update
+
+from benchmarks import load_test
+from chalicelib import search as search_module
+from chalicelib.utils import get_list
+
+app = load_test.load_app("handler", "sync", "asyncio")
+update_ids = itertools.count(1)
+
+
+def make_update_json(user_id, text):
+    update_id = next(update_ids)
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Test'}
+    return {
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'chat': {'id': user_id, 'type': 'private'},
+                    'from': user, 'text': text},
+    }
+
+
+def make_update(user_id, text):
+    return Update.de_json(make_update_json(user_id, text), app.bot)
+
+
+class TestAsyncApp(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        args = argparse.Namespace(telegram_latency_ms=0, dynamodb_latency_ms=0, api_latency_ms=0, index_latency_ms=0)
+        cls.queries = get_list(load_test.QUERIES_PATH)
+        cls.telegram, cls.patches = load_test.install_fakes(app, args, cls.queries)
+
+    @classmethod
+    def tearDownClass(cls):
+        for fake in cls.patches:
+            fake.stop()
+        search_module.set_text_search(None)
+
+    def setUp(self):
+        self.telegram.calls.clear()
+
+    def test_message_is_answered_and_counted(self):
+        asyncio.run(app.process_message_async(make_update(1001, self.queries[0])))
+
+        self.assertEqual(self.telegram.calls['sendMessage'], 1)
+        self.assertEqual(self.telegram.calls['sendPhoto'], 1)
+        self.assertEqual(app.user_requests_dao.get_user_requests_count(1001), 1)
+
+    def test_user_over_limit_is_warned_without_search(self):
+        for _ in range(5):
+            app.user_requests_dao.update_user_requests_count(1002)
+
+        with patch.object(app, 'run_search_async', new_callable=AsyncMock) as run_search_async:
+            asyncio.run(app.process_message_async(make_update(1002, self.queries[0])))
+
+        run_search_async.assert_not_called()
+        # the waiting message and the warning
+        self.assertEqual(self.telegram.calls['sendMessage'], 2)
+        self.assertEqual(app.user_requests_dao.get_user_requests_count(1002), 5)
+
+    def test_preliminary_answer_is_edited(self):
+        with patch.object(app, 'PROGRESSIVE_REPLY', True):
+            self.assertTrue(asyncio.run(app.run_search_async(1003, self.queries[0])))
+
+        self.assertEqual(self.telegram.calls['sendPhoto'], 1)
+        self.assertEqual(self.telegram.calls['editMessageCaption'], 1)
+
+    def test_failed_search_sends_service_unavailable(self):
+        with patch.object(app, 'search_async', new_callable=AsyncMock, side_effect=RuntimeError("index is down")):
+            self.assertFalse(asyncio.run(app.run_search_async(1004, self.queries[0])))
+
+        self.assertEqual(self.telegram.calls['sendMessage'], 1)
+        self.assertEqual(self.telegram.calls['sendPhoto'], 0)
+
+    def test_failure_after_the_answer_is_not_processed_again(self):
+        update_json = make_update_json(1005, self.queries[0])
+
+        with patch.object(app.user_requests_dao, 'update_user_requests_count', side_effect=RuntimeError("boom")):
+            asyncio.run(app.process_update_async(update_json))
+
+        self.assertEqual(self.telegram.calls['sendPhoto'], 1)
+        self.assertIn(str(update_json['update_id']), app.processed_updates_dao.table.items)
+
+    def test_failure_before_any_reply_is_released(self):
+        update_json = make_update_json(1006, self.queries[0])
+
+        with patch.object(app.service_switch, 'is_on', side_effect=RuntimeError("DynamoDB is down")):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(app.process_update_async(update_json))
+
+        self.assertNotIn(str(update_json['update_id']), app.processed_updates_dao.table.items)
+
+    def test_unknown_request_count_is_not_an_error(self):
+        with patch.object(app.user_requests_dao, 'update_user_requests_count', MagicMock(return_value=None)):
+            asyncio.run(app.process_message_async(make_update(1007, self.queries[0])))
+
+        self.assertEqual(self.telegram.calls['sendPhoto'], 1)
+
+    def test_embedding_is_abandoned_when_the_quota_check_fails(self):
+        abandoned = asyncio.Event()
+
+        async def embed_query_async(text, is_cancelled):
+            while not is_cancelled():
+                await asyncio.sleep(0.01)
+            abandoned.set()
+
+        async def process():
+            with self.assertRaises(RuntimeError):
+                await app.process_message_async(make_update(1008, self.queries[0]))
+            await asyncio.wait_for(abandoned.wait(), timeout=1)
+
+        with patch.object(app, 'needs_embedding', return_value=True), \
+                patch.object(app, 'embed_query_async', embed_query_async), \
+                patch.object(app, 'interaction_allowed', side_effect=RuntimeError("DynamoDB is down")):
+            asyncio.run(process())
+
+        self.assertEqual(self.telegram.calls['sendPhoto'], 0)
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+from telegram.error import TelegramError
+
+from chalicelib.async_clients import AsyncTelegramBot, Offloaded, async_google_translate, TRANSLATE_URL
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def json(self):
+        return self.payload
+
+    async def text(self):
+        return json.dumps(self.payload)
+
+    def raise_for_status(self):
+        pass
+
+
+class TestAsyncClients(unittest.TestCase):
+    @patch('chalicelib.async_clients.http_session')
+    def test_telegram_request_returns_result(self, mock_session):
+        mock_session.return_value.post.return_value = FakeResponse({'ok': True, 'result': {'message_id': 7}})
+        bot = AsyncTelegramBot("123:token")
+
+        message = asyncio.run(bot.send_message(42, "Привет", parse_mode=None))
+
+        self.assertEqual(message, {'message_id': 7})
+        mock_session.return_value.post.assert_called_once_with(
+            "https://api.telegram.org/bot123:token/sendMessage", json={'chat_id': 42, 'text': "Привет"})
+
+    @patch('chalicelib.async_clients.http_session')
+    def test_telegram_error_is_raised(self, mock_session):
+        mock_session.return_value.post.return_value = FakeResponse({'ok': False, 'description': "Forbidden"})
+
+        with self.assertRaisesRegex(TelegramError, "Forbidden"):
+            asyncio.run(AsyncTelegramBot("123:token").send_chat_action(42, "typing"))
+
+    @patch('chalicelib.async_clients.http_session')
+    def test_translate_joins_sentences(self, mock_session):
+        mock_session.return_value.get.return_value = FakeResponse(
+            [[["Who am I? ", "Кто я? ", None, None, 1], ["Silence.", "Тишина.", None, None, 1]], None, "ru"])
+
+        translation = asyncio.run(async_google_translate("Кто я? Тишина.", "ru", "en"))
+
+        self.assertEqual(translation, "Who am I? Silence.")
+        url = mock_session.return_value.get.call_args.args[0]
+        query = dict(mock_session.return_value.get.call_args.kwargs['params'])
+        self.assertEqual(url, TRANSLATE_URL)
+        self.assertEqual((query['sl'], query['tl'], query['q']), ("ru", "en", "Кто я? Тишина."))
+
+    def test_offloaded_methods_are_coroutines(self):
+        dao = MagicMock()
+        dao.user_exists.return_value = True
+
+        self.assertTrue(asyncio.run(Offloaded(dao).user_exists(42)))
+        dao.user_exists.assert_called_once_with(42)
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import unittest
+
+from chalicelib.coalescing import InFlightRequests, SingleFlight, AsyncSingleFlight
+
+
+class TestCoalescing(unittest.TestCase):
+    def test_newer_update_supersedes_older_one(self):
+        in_flight_requests = InFlightRequests()
+        first = in_flight_requests.ticket(1, 100)
+        in_flight_requests.announce(1, 101)
+        second = in_flight_requests.ticket(1, 101)
+        other_user = in_flight_requests.ticket(2, 99)
+
+        self.assertTrue(first.is_superseded())
+        self.assertFalse(second.is_superseded())
+        self.assertFalse(other_user.is_superseded())
+
+        in_flight_requests.finish(first)
+        self.assertEqual(in_flight_requests.latest(1), 101)
+        in_flight_requests.finish(second)
+        self.assertIsNone(in_flight_requests.latest(1))
+
+    def test_older_announcement_is_ignored(self):
+        in_flight_requests = InFlightRequests()
+        in_flight_requests.announce(1, 101)
+        in_flight_requests.announce(1, 100)
+
+        self.assertEqual(in_flight_requests.latest(1), 101)
+
+    def test_single_flight_shares_one_call(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow_search(call):
+            calls.append(call)
+            started.set()
+            release.wait(5)
+            return "answer"
+
+        leader = threading.Thread(target=lambda: results.append(single_flight.do("q", slow_search)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do("q", slow_search)))
+                     for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while calls[0].waiters < 3:
+            pass
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["answer"] * 4)
+
+    def test_async_single_flight_shares_one_call(self):
+        single_flight = AsyncSingleFlight()
+        calls = []
+
+        async def slow_search(call):
+            calls.append(call)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        async def main():
+            return await asyncio.gather(*(single_flight.do("q", slow_search) for _ in range(4)))
+
+        self.assertEqual(asyncio.run(main()), ["answer"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0].waiters, 3)
+
+    def test_async_single_flight_outlives_cancelled_leader(self):
+        single_flight = AsyncSingleFlight()
+
+        async def slow_search(call):
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        async def main():
+            leader = asyncio.create_task(single_flight.do("q", slow_search))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(single_flight.do("q", slow_search))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.run(main()), "answer")
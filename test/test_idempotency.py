@@ -0,0 +1,78 @@
+import contextvars
+import threading
+import unittest
+from unittest.mock import patch
+
+from benchmarks.fakes import InMemoryTable
+from chalicelib.dao import ProcessedUpdatesDao
+from chalicelib.idempotency import RecentIds, UpdateDeduplicator, tracking_side_effects, record_side_effect
+
+
+class TestIdempotency(unittest.TestCase):
+    def setUp(self):
+        with patch('chalicelib.dao.boto3'):
+            self.dao = ProcessedUpdatesDao()
+        self.dao.table = InMemoryTable('update_id')
+
+    def test_recent_ids_are_bounded(self):
+        recent_ids = RecentIds(max_size=2)
+
+        self.assertTrue(recent_ids.add(1))
+        self.assertFalse(recent_ids.add(1))
+        self.assertTrue(recent_ids.add(2))
+        self.assertTrue(recent_ids.add(3))
+        self.assertTrue(recent_ids.add(1))
+
+    def test_duplicate_in_same_container_skips_dynamodb(self):
+        deduplicator = UpdateDeduplicator(self.dao)
+
+        self.assertTrue(deduplicator.claim(100))
+        with patch.object(self.dao, 'claim') as claim:
+            self.assertFalse(deduplicator.claim(100))
+        claim.assert_not_called()
+
+    def test_duplicate_in_another_container_is_rejected_by_marker(self):
+        deduplicator = UpdateDeduplicator(self.dao, ttl_seconds=86400, lease_seconds=300)
+        self.assertTrue(deduplicator.claim(100))
+        self.assertFalse(UpdateDeduplicator(self.dao).claim(100))
+        lease_expires_at = self.dao.table.items['100']['expires_at']
+
+        deduplicator.complete(100)
+
+        self.assertFalse(UpdateDeduplicator(self.dao).claim(100))
+        self.assertGreater(self.dao.table.items['100']['expires_at'], lease_expires_at + 80000)
+
+    def test_failed_update_is_processed_again(self):
+        deduplicator = UpdateDeduplicator(self.dao)
+        self.assertTrue(deduplicator.claim(100))
+
+        deduplicator.release(100)
+
+        self.assertTrue(deduplicator.claim(100))
+        self.assertTrue(UpdateDeduplicator(self.dao).claim(200))
+
+    def test_expired_lease_of_a_crashed_container_is_claimed_again(self):
+        self.assertTrue(UpdateDeduplicator(self.dao, lease_seconds=-1).claim(100))
+
+        self.assertTrue(UpdateDeduplicator(self.dao).claim(100))
+
+    def test_lease_of_a_crashed_polling_worker_is_claimed_again(self):
+        self.assertTrue(UpdateDeduplicator(self.dao, owner="polling-worker").claim(100))
+        self.assertTrue(UpdateDeduplicator(self.dao, owner="polling-worker").claim(200))
+
+        restarted = UpdateDeduplicator(self.dao, owner="polling-worker")
+        self.assertFalse(UpdateDeduplicator(self.dao).claim(100))
+        self.assertTrue(restarted.claim(100))
+        restarted.complete(100)
+
+        self.assertFalse(UpdateDeduplicator(self.dao, owner="polling-worker").claim(100))
+        self.assertNotIn('lease_owner', self.dao.table.items['100'])
+
+    def test_side_effects_are_tracked_across_threads(self):
+        record_side_effect()
+        with tracking_side_effects() as side_effects:
+            self.assertFalse(side_effects.is_set())
+            stage = threading.Thread(target=contextvars.copy_context().run, args=(record_side_effect,))
+            stage.start()
+            stage.join()
+            self.assertTrue(side_effects.is_set())
@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+import unittest
+
+from chalicelib.ingestion import Checkpoint, Ingestion, chunk_transcript, meaning_record_id
+from chalicelib.local_index import LocalIndex
+
+
+def fake_embed(texts):
+    return [[float(len(text)), 1.0] for text in texts], len(texts)
+
+
+def make_segments(count, duration=10):
+    return [{'text': f'фраза {number}', 'start': number * duration + 0.5, 'duration': duration}
+            for number in range(count)]
+
+
+class TestIngestion(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.transcripts_dir = self.directory.name
+        self.videos = [{'video_id': video_id, 'title': 'Title', 'published': '2022-12-10'}
+                       for video_id in ('video1', 'video2')]
+        for video in self.videos:
+            with open(os.path.join(self.transcripts_dir, f"{video['video_id']}.json"), 'w') as f:
+                json.dump(make_segments(70), f)
+        self.embed_calls = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_ingestion(self, index):
+        def embed(texts):
+            self.embed_calls.append(len(texts))
+            return fake_embed(texts)
+
+        checkpoint = Checkpoint(os.path.join(self.transcripts_dir, "checkpoint.json"))
+        return Ingestion(index, checkpoint, self.transcripts_dir, embedding_batch_size=5, upsert_batch_size=4,
+                         translate=False, embed=embed)
+
+    def test_chunk_transcript(self):
+        texts, meanings = chunk_transcript(self.videos[0], make_segments(70))
+
+        self.assertEqual(meanings[0]['id'], meaning_record_id('video1', 0))
+        self.assertEqual(len(texts), 12)
+        self.assertEqual(len(meanings), 3)
+        self.assertTrue(all(text['metadata']['meaning_id'] in {m['id'] for m in meanings} for text in texts))
+        self.assertTrue(texts[0]['text'].startswith('фраза 0 фраза 1'))
+
+    def test_only_new_videos_are_ingested(self):
+        index = LocalIndex()
+
+        self.assertEqual(self.make_ingestion(index).run(self.videos[:1], max_workers=2), 1)
+        self.embed_calls.clear()
+        self.assertEqual(self.make_ingestion(index).run(self.videos, max_workers=2), 1)
+
+        stats = index.describe_index_stats()['namespaces']
+        self.assertEqual(stats['text']['vector_count'], 24)
+        self.assertEqual(stats['meaning']['vector_count'], 6)
+        self.assertTrue(all(batch <= 5 for batch in self.embed_calls))
+
+    def test_indexed_videos_are_detected_without_checkpoint(self):
+        index = LocalIndex()
+        self.make_ingestion(index).run(self.videos[:1])
+        os.remove(os.path.join(self.transcripts_dir, "checkpoint.json"))
+
+        pending = self.make_ingestion(index).pending_videos(self.videos)
+
+        self.assertEqual([video['video_id'] for video in pending], ['video2'])
+
+    def test_empty_transcript_is_not_ingested_again(self):
+        with open(os.path.join(self.transcripts_dir, "video2.json"), 'w') as f:
+            json.dump([{'text': ' ', 'start': 0.5, 'duration': 10}], f)
+        index = LocalIndex()
+
+        self.assertEqual(self.make_ingestion(index).run(self.videos), 2)
+        os.remove(os.path.join(self.transcripts_dir, "checkpoint.json"))
+
+        self.assertEqual(self.make_ingestion(index).pending_videos(self.videos), [])
+        self.assertEqual(index.describe_index_stats()['namespaces']['text']['vector_count'], 12)
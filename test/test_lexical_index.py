@@ -0,0 +1,105 @@
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+import numpy as np
+
+from chalicelib import search as search_module
+from chalicelib.lexical_index import LexicalIndex, analyze
+from chalicelib.search import TextSearch
+
+
+def make_record(video_id, start, text, title):
+    return {
+        'id': f'{video_id}-t{start}-c',
+        'text': text,
+        'title': title,
+        'metadata': {
+            'meaning_id': f'{video_id}-t0',
+            'text': text,
+            'title': title,
+            'url': f'https://www.youtube.com/watch?v={video_id}',
+            'start': float(start),
+            'published': '2022-12-10',
+        },
+    }
+
+
+RECORDS = [
+    make_record('video1', 0, 'Страх смерти уходит, когда мы смотрим на него прямо', 'О страхе'),
+    make_record('video1', 60, 'Смерть тела не касается сознания', 'О страхе'),
+    make_record('video2', 0, 'Медитация начинается с внимания к дыханию', 'Практика медитации'),
+    make_record('video3', 0, 'Любовь и привязанность не одно и то же', 'О любви'),
+    make_record('video4', 0, 'Смерть приходит к каждому, кто родился', 'О смерти'),
+]
+
+
+class TestLexicalIndex(unittest.TestCase):
+    def test_analyze_stems_word_forms(self):
+        self.assertEqual(analyze("Страх страхи страхом"), ['страх'] * 3)
+        self.assertEqual(analyze("медитация медитации медитацией"), ['медитац'] * 3)
+        self.assertEqual(analyze("что это и как"), [])
+
+    def test_saved_index_is_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as path:
+            LexicalIndex.build(RECORDS).save(path)
+            index = LexicalIndex.load(path)
+
+            matches = index.search("страхи смерти", top_k=2)
+
+            self.assertIsInstance(index.postings, np.memmap)
+            self.assertEqual(matches[0]['id'], 'video1-t0-c')
+            self.assertEqual(matches[0]['score'], 1.0)
+            self.assertNotIn('text', matches[0]['metadata'])
+        self.assertIsNone(LexicalIndex.load("does/not/exist"))
+
+    @patch('chalicelib.search.get_random_next_question', return_value='Next?')
+    @patch('chalicelib.search.get_random_response', return_value='Results:')
+    @patch('chalicelib.search.generate_embedding')
+    @patch('chalicelib.search.google_translate')
+    def test_keyword_query_skips_embedding(self, mock_translate, mock_embedding, *_):
+        index = MagicMock()
+        search_module.set_text_search(TextSearch(index=index, titles={}, lexical_index=LexicalIndex.build(RECORDS)))
+        try:
+            answer = search_module.search("медитация")
+        finally:
+            search_module.set_text_search(None)
+
+        self.assertIn('["Практика медитации"](https://www.youtube.com/watch?v=video2&t=0)', answer)
+        mock_translate.assert_not_called()
+        mock_embedding.assert_not_called()
+        index.query.assert_not_called()
+
+    def test_common_term_is_not_confident(self):
+        text_search = TextSearch(index=MagicMock(), titles={}, lexical_index=LexicalIndex.build(RECORDS))
+
+        self.assertIsNotNone(text_search.lexical_fast_path("медитация"))
+        # the first and the last satsang both speak of death
+        self.assertIsNone(text_search.lexical_fast_path("смерть"))
+        # half of the query is unknown
+        self.assertIsNone(text_search.lexical_fast_path("медитация квазар"))
+
+    def test_title_query_takes_fast_path(self):
+        text_search = TextSearch(index=MagicMock(), titles={}, lexical_index=LexicalIndex.build(RECORDS))
+
+        # every chunk of the satsang carries its title, the runner-up is another satsang
+        hits = text_search.lexical_fast_path("страх")
+
+        self.assertIsNotNone(hits)
+        self.assertEqual([hit.title for hit in hits], ['О страхе'])
+
+    @patch('chalicelib.search.generate_embedding', return_value=([0.1], 1))
+    @patch('chalicelib.search.google_translate', return_value="death")
+    def test_lexical_matches_are_computed_once_per_query(self, *_):
+        index = MagicMock()
+        index.query.return_value = {'matches': []}
+        lexical_index = LexicalIndex.build(RECORDS)
+        search_module.set_text_search(TextSearch(index=index, titles={}, lexical_index=lexical_index))
+        try:
+            with patch.object(lexical_index, 'search', wraps=lexical_index.search) as lexical_search:
+                self.assertTrue(search_module.needs_embedding("смерть"))
+                search_module.search("смерть")
+        finally:
+            search_module.set_text_search(None)
+
+        lexical_search.assert_called_once()
@@ -0,0 +1,133 @@
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from benchmarks.fakes import FakeTelegramRequest
+from chalicelib.polling import LongPollingWorker
+
+
+def make_update(update_id, chat_id):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'chat': {'id': chat_id}, 'text': 'q'}}
+
+
+class TestLongPollingWorker(unittest.TestCase):
+    def setUp(self):
+        self.telegram = FakeTelegramRequest()
+        self.bot = SimpleNamespace(request=self.telegram, base_url="https://api.telegram.org/bot1:test",
+                                   delete_webhook=lambda: True)
+
+    def test_updates_keep_chat_order_and_are_confirmed(self):
+        processed = []
+        lock = threading.Lock()
+
+        def process_update(update_json):
+            if update_json['update_id'] == 1:
+                time.sleep(0.05)
+            if update_json['update_id'] == 5:
+                raise ValueError("boom")
+            with lock:
+                processed.append(update_json['update_id'])
+
+        worker = LongPollingWorker(self.bot, process_update, max_workers=3, poll_timeout=0.1)
+        confirmations = [self.telegram.push_update(make_update(update_id, chat_id))
+                         for update_id, chat_id in [(1, 10), (2, 20), (3, 10), (4, 20), (5, 30)]]
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        try:
+            self.assertTrue(all(confirmed.wait(5) for confirmed in confirmations))
+        finally:
+            worker.stop()
+            thread.join(5)
+
+        self.assertCountEqual(processed, [1, 2, 3, 4])
+        self.assertLess(processed.index(1), processed.index(3))
+        self.assertLess(processed.index(2), processed.index(4))
+        self.assertEqual(worker.offset, 6)
+
+    def test_slow_chat_does_not_hold_back_other_chats(self):
+        release = threading.Event()
+        other_chat_done = threading.Event()
+
+        def process_update(update_json):
+            if update_json['message']['chat']['id'] == 10:
+                release.wait(5)
+            else:
+                other_chat_done.set()
+
+        worker = LongPollingWorker(self.bot, process_update, max_workers=2, poll_timeout=0.1)
+        self.telegram.push_update(make_update(1, 10))
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        try:
+            time.sleep(0.2)
+            self.telegram.push_update(make_update(2, 20))
+            self.assertTrue(other_chat_done.wait(2))
+            self.assertEqual(worker.checkpoint, 1)
+        finally:
+            release.set()
+            worker.stop()
+            thread.join(5)
+
+    def test_stop_waits_for_the_updates_in_progress(self):
+        started = threading.Event()
+        release = threading.Event()
+        processed = []
+
+        def process_update(update_json):
+            started.set()
+            release.wait(5)
+            processed.append(update_json['update_id'])
+
+        worker = LongPollingWorker(self.bot, process_update, poll_timeout=0.1)
+        confirmed = self.telegram.push_update(make_update(7, 10))
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        started.wait(5)
+        worker.stop()
+        thread.join(0.3)
+        self.assertTrue(thread.is_alive())
+
+        release.set()
+        thread.join(5)
+        self.assertEqual(processed, [7])
+        self.assertTrue(confirmed.is_set())
+
+    def test_updates_left_in_progress_are_replayed(self):
+        processed = []
+
+        with tempfile.TemporaryDirectory() as path:
+            pending_path = os.path.join(path, "pending.json")
+            with open(pending_path, 'w') as f:
+                json.dump({'updates': [make_update(3, 10), make_update(4, 20)]}, f)
+
+            worker = LongPollingWorker(self.bot, lambda update_json: processed.append(update_json['update_id']),
+                                       poll_timeout=0.1, pending_path=pending_path)
+            confirmed = self.telegram.push_update(make_update(5, 10))
+            thread = threading.Thread(target=worker.run)
+            thread.start()
+            try:
+                self.assertTrue(confirmed.wait(5))
+            finally:
+                worker.stop()
+                thread.join(5)
+
+            with open(pending_path) as f:
+                self.assertEqual(json.load(f), {'updates': []})
+        self.assertCountEqual(processed, [3, 4, 5])
+        self.assertLess(processed.index(3), processed.index(5))
+
+    def test_signal_stops_after_the_current_poll(self):
+        worker = LongPollingWorker(self.bot, lambda update_json: None, poll_timeout=0.2)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        time.sleep(0.1)
+
+        worker.handle_signal(signal.SIGTERM, None)
+
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
@@ -1,36 +1,185 @@
+import asyncio
 import unittest
-from unittest.mock import patch
-from chalicelib.search import search
+from concurrent.futures import Future
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from chalicelib import search as search_module
+from chalicelib.search import search, search_async, batch_search, TextSearch, SearchHit
+from chalicelib.utils import google_translate_batch
+
+
+def make_text(text_id, score, meaning_id, title):
+    return {
+        'id': text_id,
+        'score': score,
+        'metadata': {
+            'meaning_id': meaning_id,
+            'text': 'Text',
+            'title': title,
+            'url': f'https://www.youtube.com/watch?v={text_id.split("-")[0]}',
+            'start': 12.0,
+            'published': '2022-12-10',
+        },
+    }
 
 
 class TestSearch(unittest.TestCase):
-    @patch('chalicelib.api._search', autospec=True)
-    def test_search(self, mock_search):
-        mock_search.return_value = [
-            {
-                'title': 'Title 1',
-                'text': 'Text 1',
-                'url': 'http://example.com/1',
-                'text_relevance': 0.91,
-                'meaning_relevance': 0.78,
-                'start': '0',
-            },
-            {
-                'title': 'Title 2',
-                'text': 'Text 2',
-                'url': 'http://example.com/2',
-                'text_relevance': 0.9,
-                'meaning_relevance': 0.98,
-                'start': '0',
-            },
-        ]
-
-        query = "test query"
-        expected_answer = ('Лучшие результаты по вопросу "{}":\n\n'
-                           '1) Title 1\nhttp://example.com/1\nРелевантность по тексту: 0.91\nРелевантность по смыслу: 0.78\n\n'
-                           '2) Title 2\nhttp://example.com/2\nРелевантность по тексту: 0.9\nРелевантность по смыслу: 0.98\n\n').format(query)
+    def setUp(self):
+        index = MagicMock()
+        index.query.side_effect = lambda vector, namespace, **kwargs: {
+            'text': {'matches': [
+                make_text('video1-t0-c', 0.9, 'video1-t0', 'Title 1'),
+                make_text('video1-t75-c', 0.8, 'video1-t0', 'Title 1'),
+                make_text('video2-t0-c', 0.7, 'video2-t0', 'Title 2'),
+            ]},
+            'meaning': {'matches': [
+                {'id': 'video1-t0', 'score': 0.5},
+                {'id': 'video2-t0', 'score': 0.9},
+            ]},
+        }[namespace]
+        search_module.set_text_search(TextSearch(index=index, titles={}))
+
+    def tearDown(self):
+        search_module.set_text_search(None)
+
+    @patch('chalicelib.search.get_random_next_question', return_value='Next?')
+    @patch('chalicelib.search.get_random_response', return_value='Results:')
+    @patch('chalicelib.search.generate_embedding', return_value=([0.1, 0.2], 3))
+    @patch('chalicelib.search.google_translate', return_value='test query')
+    def test_search(self, mock_translate, mock_embedding, *_):
+        query = "тестовый запрос"
+        expected_answer = ('Results:\n\n'
+                           '👉 Из сатсанга ["Title 2"](https://www.youtube.com/watch?v=video2&t=12)\n\n'
+                           '👉 Из сатсанга ["Title 1"](https://www.youtube.com/watch?v=video1&t=12)\n\n'
+                           'Next?')
 
         actual_answer = search(query)
 
         self.assertEqual(actual_answer, expected_answer)
-        mock_search.assert_called_once_with(query, 5)
+        mock_translate.assert_called_once_with(query, "ru", "en")
+        mock_embedding.assert_called_once_with('test query')
+
+    def test_search_without_results(self):
+        search_module.get_text_search().index.query.side_effect = lambda *args, **kwargs: {'matches': []}
+
+        with patch('chalicelib.search.google_translate', return_value='q'), \
+                patch('chalicelib.search.generate_embedding', return_value=([0.1], 1)):
+            answer = search("запрос")
+
+        self.assertTrue(answer.startswith("Ой, кажется"))
+
+    @patch('chalicelib.search.generate_embeddings', side_effect=lambda texts: ([[0.1, 0.2]] * len(texts), 5))
+    @patch('chalicelib.search.google_translate_batch', side_effect=lambda texts, src, target: list(texts))
+    def test_batch_search(self, mock_translate, mock_embeddings):
+        results = batch_search(["q1", "q2", "q3"], top_k=1, batch_size=2)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual([result[0]['id'] for result in results], ['video2-t0-c'] * 3)
+        self.assertEqual(mock_translate.call_count, 2)
+        self.assertEqual(mock_embeddings.call_count, 2)
+
+    @patch('chalicelib.utils.Translator')
+    def test_batch_translation_keeps_order(self, mock_translator):
+        mock_translator.return_value.translate.side_effect = lambda text, src, dest: MagicMock(text=text.upper())
+
+        self.assertEqual(google_translate_batch(["a", "b", "c"], "ru", "en", max_workers=2), ["A", "B", "C"])
+        self.assertEqual(mock_translator.return_value.translate.call_count, 3)
+
+    @patch('chalicelib.search.get_cached_results')
+    @patch('chalicelib.search.google_translate')
+    def test_search_uses_precomputed_results(self, mock_translate, mock_cached_results):
+        mock_cached_results.return_value = [{'title': 'Cached', 'url': 'https://example.com'}]
+
+        answer = search("Популярный вопрос?")
+
+        self.assertIn('["Cached"](https://example.com)', answer)
+        mock_translate.assert_not_called()
+
+    @patch('chalicelib.search.get_random_preliminary_text', return_value='First:')
+    @patch('chalicelib.search.generate_embedding', return_value=([0.1, 0.2], 3))
+    @patch('chalicelib.search.google_translate', return_value='test query')
+    def test_search_sends_preliminary_answer(self, *_):
+        preliminary_answers = []
+
+        answer = search("тестовый запрос", on_preliminary=preliminary_answers.append)
+
+        self.assertEqual(preliminary_answers,
+                         ['First:\n\n👉 Из сатсанга ["Title 1"](https://www.youtube.com/watch?v=video1&t=12)'])
+        self.assertIn('["Title 2"]', answer)
+
+    @patch('chalicelib.search.google_translate')
+    def test_search_uses_started_embedding(self, mock_translate):
+        embedding_future = Future()
+        embedding_future.set_result([0.1, 0.2])
+
+        answer = search("тестовый запрос", embedding_future=embedding_future)
+
+        self.assertIn('["Title 2"]', answer)
+        mock_translate.assert_not_called()
+
+    @patch('chalicelib.search.get_random_next_question', return_value='Next?')
+    @patch('chalicelib.search.get_random_response', return_value='Results:')
+    @patch('chalicelib.search.async_generate_embedding', new_callable=AsyncMock, return_value=([0.1, 0.2], 3))
+    @patch('chalicelib.search.async_google_translate', new_callable=AsyncMock, return_value='test query')
+    def test_search_async(self, mock_translate, mock_embedding, *_):
+        expected_answer = ('Results:\n\n'
+                           '👉 Из сатсанга ["Title 2"](https://www.youtube.com/watch?v=video2&t=12)\n\n'
+                           '👉 Из сатсанга ["Title 1"](https://www.youtube.com/watch?v=video1&t=12)\n\n'
+                           'Next?')
+
+        answer = asyncio.run(search_async("тестовый запрос"))
+
+        self.assertEqual(answer, expected_answer)
+        mock_translate.assert_awaited_once_with("тестовый запрос", "ru", "en")
+        mock_embedding.assert_awaited_once_with('test query')
+
+    @patch('chalicelib.search.get_random_preliminary_text', return_value='First:')
+    @patch('chalicelib.search.async_generate_embedding', new_callable=AsyncMock, return_value=([0.1, 0.2], 3))
+    @patch('chalicelib.search.async_google_translate', new_callable=AsyncMock, return_value='test query')
+    def test_search_async_sends_preliminary_answer(self, *_):
+        preliminary_answers = []
+
+        async def on_preliminary(answer):
+            preliminary_answers.append(answer)
+
+        answer = asyncio.run(search_async("тестовый запрос", on_preliminary=on_preliminary))
+
+        self.assertEqual(preliminary_answers,
+                         ['First:\n\n👉 Из сатсанга ["Title 1"](https://www.youtube.com/watch?v=video1&t=12)'])
+        self.assertIn('["Title 2"]', answer)
+
+    @patch('chalicelib.search.async_google_translate', new_callable=AsyncMock)
+    def test_search_async_uses_started_embedding(self, mock_translate):
+        async def main():
+            embedding_task = asyncio.ensure_future(asyncio.sleep(0, result=[0.1, 0.2]))
+            return await search_async("тестовый запрос", embedding_task=embedding_task)
+
+        self.assertIn('["Title 2"]', asyncio.run(main()))
+        mock_translate.assert_not_called()
+
+    def test_display_fields_are_filled_for_shown_hits_only(self):
+        text_search = search_module.get_text_search()
+        texts = text_search.index.query([0.1], namespace='text')
+        meanings = text_search.index.query([0.1], namespace='meaning')
+
+        hits = text_search.order_by_joint_relevance(texts, meanings)
+        shown = text_search.describe(text_search.top_per_video(hits, 1))
+
+        self.assertEqual([hit.title for hit in hits], ['Title 2', None, None])
+        self.assertEqual(shown[0].url, 'https://www.youtube.com/watch?v=video2&t=12')
+
+    def test_top_per_video_keeps_dashed_video_ids_apart(self):
+        hits = [SearchHit(hit_id, hit_id.rsplit('-', 1)[0], relevance, relevance, None, {})
+                for hit_id, relevance in [('QU-oQ-K-zHA-t0-c', 0.9), ('QU-oQ-K-zHA-t60-c', 0.8),
+                                          ('QU-xyz-t0-c', 0.7), ('QU-t1-c', 0.6)]]
+
+        top_hits = TextSearch.top_per_video(hits, 5)
+
+        self.assertEqual([hit.id for hit in top_hits], ['QU-oQ-K-zHA-t0-c', 'QU-xyz-t0-c', 'QU-t1-c'])
+
+    @patch('chalicelib.search.get_random_next_question', return_value='Next?')
+    @patch('chalicelib.search.get_random_response', return_value='Results:')
+    def test_render_answer_keeps_links_intact(self, *_):
+        answer = search_module.render_answer([{'title': 'Кто я? [часть 1]', 'url': 'https://example.com'}])
+
+        self.assertEqual(answer, 'Results:\n\n👉 Из сатсанга ["Кто я? (часть 1)"](https://example.com)\n\nNext?')
@@ -0,0 +1,49 @@
+import json
+import unittest
+
+from chalicelib.tracing import Histogram, Tracer
+
+
+class TestTracing(unittest.TestCase):
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for value in range(1, 101):
+            histogram.record(value)
+
+        summary = histogram.summary()
+
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['p50'], 50)
+        self.assertEqual(summary['p95'], 95)
+        self.assertEqual(summary['p99'], 99)
+
+    def test_trace_emits_emf_line(self):
+        lines = []
+        tracer = Tracer(namespace="Test", emit=lines.append)
+
+        with tracer.trace(42):
+            with tracer.span("translate"):
+                pass
+            with tracer.span("telegram.send_message"):
+                pass
+            with tracer.span("telegram.send_message"):
+                pass
+
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record['UpdateId'], 42)
+        self.assertEqual(record['_aws']['CloudWatchMetrics'][0]['Namespace'], "Test")
+        self.assertIsInstance(record['translate'], float)
+        self.assertEqual(len(record['telegram.send_message']), 2)
+        self.assertEqual(tracer.snapshot()['telegram.send_message']['count'], 2)
+
+    def test_unsampled_trace_records_nothing(self):
+        lines = []
+        tracer = Tracer(sample_rate=0, emit=lines.append)
+
+        with tracer.trace(1):
+            with tracer.span("translate"):
+                pass
+
+        self.assertEqual(lines, [])
+        self.assertEqual(tracer.snapshot(), {})
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import unittest
+
+from chalicelib.update_queue import InMemoryUpdateQueue, LocalUpdateWorker, chat_id_of, is_valid_update, \
+    process_batch, process_batch_async
+
+
+def make_update(update_id, chat_id):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'chat': {'id': chat_id}, 'text': 'q'}}
+
+
+class TestUpdateQueue(unittest.TestCase):
+    def test_validation(self):
+        self.assertTrue(is_valid_update(make_update(1, 2)))
+        self.assertFalse(is_valid_update({'message': {}}))
+        self.assertFalse(is_valid_update([1]))
+        self.assertEqual(chat_id_of(make_update(1, 2)), 2)
+
+    def test_process_batch_keeps_chat_order_and_reports_failures(self):
+        processed = []
+        lock = threading.Lock()
+
+        def process_update(update_json):
+            if update_json['update_id'] == 5:
+                raise ValueError("boom")
+            with lock:
+                processed.append(update_json['update_id'])
+
+        updates = [make_update(1, 10), make_update(2, 20), make_update(3, 10), make_update(4, 20), make_update(5, 30)]
+        failed = process_batch(updates, process_update, max_workers=3)
+
+        self.assertEqual([update['update_id'] for update in failed], [5])
+        self.assertLess(processed.index(1), processed.index(3))
+        self.assertLess(processed.index(2), processed.index(4))
+
+    def test_process_batch_async_keeps_chat_order(self):
+        processed = []
+
+        async def process_update(update_json):
+            if update_json['update_id'] == 5:
+                raise ValueError("boom")
+            # the first update of a chat is the slowest, later ones must still wait for it
+            await asyncio.sleep(0.01 if update_json['update_id'] < 3 else 0)
+            processed.append(update_json['update_id'])
+
+        updates = [make_update(1, 10), make_update(2, 20), make_update(3, 10), make_update(4, 20), make_update(5, 30)]
+        failed = asyncio.run(process_batch_async(updates, process_update, max_concurrency=3))
+
+        self.assertEqual([update['update_id'] for update in failed], [5])
+        self.assertLess(processed.index(1), processed.index(3))
+        self.assertLess(processed.index(2), processed.index(4))
+
+    def test_local_worker_consumes_queue(self):
+        update_queue = InMemoryUpdateQueue()
+        processed = []
+        worker = LocalUpdateWorker(update_queue, lambda update: processed.append(update['update_id']),
+                                   batch_size=2, max_workers=1).start()
+        for update_id in range(5):
+            update_queue.enqueue(make_update(update_id, 1))
+
+        update_queue.join()
+        worker.stop()
+
+        self.assertEqual(processed, list(range(5)))
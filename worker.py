@@ -0,0 +1,39 @@
+"""Runs the bot as a long-running process that polls Telegram for updates, instead of the webhook Lambda.
+
+Run from the repository root with the same environment variables as the Lambda:
+
+    STAGE=prod python worker.py
+
+SIGTERM and SIGINT stop the worker after the current poll and the updates in progress and commit the offset after them.
+"""
+import os
+import signal
+import sys
+
+import app
+from chalicelib.polling import LongPollingWorker
+
+POLL_LIMIT = int(os.environ.get("POLL_LIMIT", "100"))
+# a stop is noticed between polls
+POLL_TIMEOUT_SECONDS = int(os.environ.get("POLL_TIMEOUT_SECONDS", "5"))
+# updates fetched and not finished yet, the rest wait on the Telegram side
+POLL_MAX_PENDING = int(os.environ.get("POLL_MAX_PENDING", "50"))
+# the updates in progress, replayed after a crash; keep it on a volume that outlives the container
+POLL_PENDING_PATH = os.environ.get("POLL_PENDING_PATH", ".polling_pending.json")
+# getUpdates serves one consumer per bot, the leases of this owner found at start are of a crashed worker
+LEASE_OWNER = "polling-worker"
+
+
+def main():
+    app.warm_up()
+    app.update_deduplicator.owner = LEASE_OWNER
+    worker = LongPollingWorker(app.bot, app.handle_update, app.announce_update, app.WORKER_CONCURRENCY, POLL_LIMIT,
+                               POLL_TIMEOUT_SECONDS, POLL_MAX_PENDING, pending_path=POLL_PENDING_PATH)
+    signal.signal(signal.SIGTERM, worker.handle_signal)
+    signal.signal(signal.SIGINT, worker.handle_signal)
+    worker.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())